@@ -0,0 +1,8 @@
+import os
+import sys
+
+# the audio_spliter scripts run from their own directory and import the repo's src package,
+# imported for this side effect before any `from src...` import
+ROOT_PATH = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+if ROOT_PATH not in sys.path:
+    sys.path.append(ROOT_PATH)
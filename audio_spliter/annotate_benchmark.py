@@ -0,0 +1,71 @@
+import json
+import time
+
+import torch
+
+from annotate_dataset import AnnotateData
+from annotate_export import AnnotateRuntime, build_inference, frame_pairs
+
+
+# accuracy and latency of the exported artifact against the fp32 model on generated files, and
+# the artifact's throughput with export.num_workers concurrent requests. Both models come from
+# export.checkpoint, without one the artifact's weights are a random init that cannot be rebuilt
+@torch.no_grad()
+def compare(config, num_files):
+    export_config = config["export"]
+    if export_config["checkpoint"] is None:
+        raise ValueError("export.checkpoint is null, set it to the checkpoint the artifact was exported from")
+
+    runtime = AnnotateRuntime(export_config["path"], export_config["num_workers"], export_config["intra_op_threads"])
+    reference = build_inference(config, export_config["checkpoint"], quantize=False)
+    dataset = AnnotateData(config)
+
+    reference_secs, runtime_secs = 0.0, 0.0
+    num_windows, position_error, state_error, state_agree = 0, 0.0, 0.0, 0
+    waveforms = []
+    for index in range(min(num_files, len(dataset))):
+        original, cover = (waveform.to("cpu") for waveform in dataset.load_waveforms(index))
+        waveforms.append((original, cover))
+        original_windows, cover_windows, _ = frame_pairs(original, cover, runtime.settings)
+
+        start_time = time.perf_counter()
+        y_position, y_state = reference(original_windows, cover_windows)
+        reference_secs += time.perf_counter() - start_time
+
+        start_time = time.perf_counter()
+        q_position, q_state = runtime.module(original_windows, cover_windows)
+        runtime_secs += time.perf_counter() - start_time
+
+        num_windows += y_state.size(0)
+        position_error += float((q_position - y_position).abs().sum()) / 2
+        state_error += float((q_state - y_state).abs().sum())
+        state_agree += int(((q_state > 0.5) == (y_state > 0.5)).sum())
+
+    start_time = time.perf_counter()
+    for future in [runtime.submit(original, cover) for original, cover in waveforms]:
+        future.result()
+    concurrent_secs = time.perf_counter() - start_time
+
+    runtime.close()
+    num_files = len(waveforms)
+    return {
+        "files": num_files,
+        "windows": num_windows,
+        "workers": export_config["num_workers"],
+        "fp32_ms_per_file": reference_secs / max(num_files, 1) * 1000,
+        "artifact_ms_per_file": runtime_secs / max(num_files, 1) * 1000,
+        "speedup": reference_secs / max(runtime_secs, 1e-9),
+        "artifact_files_per_sec": num_files / max(concurrent_secs, 1e-9),
+        "position_mae": position_error / max(num_windows, 1),
+        "state_mae": state_error / max(num_windows, 1),
+        "state_agreement": state_agree / max(num_windows, 1)
+    }
+
+
+if __name__ == "__main__":
+    with open("config.json", "r") as j_file:
+        audio_spliter_config = json.load(j_file)
+
+    results = compare(audio_spliter_config, audio_spliter_config["export"]["benchmark_files"])
+    for key, value in results.items():
+        print(f"{key}: {value:.4f}" if isinstance(value, float) else f"{key}: {value}")
@@ -0,0 +1,176 @@
+import json
+import os
+import random
+import time
+
+import numpy as np
+import torch
+
+from annotate_dataset import AnnotateData
+
+CORPUS_VERSION = 1
+SPLITS = ("train", "valid", "test")
+
+
+def _encode_audio(waveform, dtype):
+    waveform = waveform.to("cpu").numpy()
+    if dtype == "int16":
+        return np.clip(np.round(waveform * 32767), -32768, 32767).astype(np.int16)
+    return waveform.astype(dtype)
+
+
+# appends arrays to numbered shard files, starting a new shard once one reaches shard_bytes
+class ShardWriter:
+    def __init__(self, corpus_path, dtype, shard_bytes):
+        self.corpus_path = corpus_path
+        self.dtype = np.dtype(dtype)
+        self.shard_bytes = shard_bytes
+        self.shard = -1
+        self.offset = 0
+        self.file = None
+
+    def _next_shard(self):
+        self.close()
+        self.shard += 1
+        self.offset = 0
+        self.file = open(os.path.join(self.corpus_path, f"shard_{self.shard:04d}.bin.tmp"), "wb")
+
+    def append(self, array):
+        if self.file is None or (self.offset > 0 and (self.offset + array.size) * self.dtype.itemsize > self.shard_bytes):
+            self._next_shard()
+
+        self.file.write(np.ascontiguousarray(array, dtype=self.dtype).tobytes())
+        shard, offset = self.shard, self.offset
+        self.offset += array.size
+        return shard, offset
+
+    def close(self):
+        if self.file is not None:
+            self.file.close()
+            path = os.path.join(self.corpus_path, f"shard_{self.shard:04d}.bin")
+            os.replace(path + ".tmp", path)
+            self.file = None
+
+
+# pack every generated file into a few large shards: originals once per video and changed audio
+# as contiguous [channels, samples] blocks at generate_sample_rate, and one index.npz with their
+# offsets, the segment columns, the window counts and the split of every file
+def pack_corpus(config):
+    corpus_config = config["corpus"]
+    corpus_path = corpus_config["path"]
+    if not os.path.isdir(corpus_path):
+        os.makedirs(corpus_path)
+
+    dataset = AnnotateData(dict(config, use_gpu=False))
+    writer = ShardWriter(corpus_path, corpus_config["dtype"], int(corpus_config["shard_gigabytes"] * 1024 ** 3))
+
+    originals = {}
+    audio_columns = {name: [] for name in ("shard", "offset", "channels", "frames")}
+    file_columns = {name: [] for name in ("original", "changed", "windows")}
+
+    def add_audio(waveform):
+        shard, offset = writer.append(_encode_audio(waveform, corpus_config["dtype"]))
+        for name, value in zip(audio_columns, (shard, offset, waveform.shape[0], waveform.shape[-1])):
+            audio_columns[name].append(value)
+        return len(audio_columns["shard"]) - 1
+
+    start_time = time.time()
+    for index, file_name in enumerate(dataset.annotate_files):
+        print(f"Packing corpus, {index + 1}/{len(dataset)}, current: {file_name}", end="\r")
+        original_wav, changed_wav = dataset.load_waveforms(index, dataset.generate_sample_rate, "cpu")
+
+        video_id = file_name[:-3]
+        if video_id not in originals:
+            originals[video_id] = add_audio(original_wav)
+        file_columns["original"].append(originals[video_id])
+        file_columns["changed"].append(add_audio(changed_wav))
+        file_columns["windows"].append(dataset.window_count(index))
+    writer.close()
+
+    # the same split sizes as AnnotateDataModule, drawn once and kept with the corpus
+    num_files = len(dataset)
+    num_test = int(config["dataset"]["num_data"] * config["dataset"]["test"])
+    num_valid = int(config["dataset"]["num_data"] * config["dataset"]["validation"])
+    order = list(range(num_files))
+    random.Random(config["generate"]["seed"]).shuffle(order)
+    split = np.zeros(num_files, dtype=np.uint8)
+    split[order[:num_valid]] = SPLITS.index("valid")
+    split[order[num_valid:num_valid + num_test]] = SPLITS.index("test")
+
+    segment_index = dataset.segment_index
+    rows = [segment_index.rows[file_name] for file_name in dataset.annotate_files]
+    counts = segment_index.segment_counts()[rows]
+    segments = [segment_index[file_name] for file_name in dataset.annotate_files]
+
+    tmp_path = os.path.join(corpus_path, "index.npz.tmp")
+    with open(tmp_path, "wb") as file:
+        np.savez(
+            file, version=np.int64(CORPUS_VERSION), dtype=np.array(corpus_config["dtype"]),
+            sample_rate=np.int64(dataset.generate_sample_rate), names=np.array(dataset.annotate_files, dtype=str),
+            split=split, **{f"audio_{name}": np.array(values, dtype=np.int64) for name, values in audio_columns.items()},
+            **{f"file_{name}": np.array(values, dtype=np.int64) for name, values in file_columns.items()},
+            seconds_per_segment=np.array([seconds for seconds, _, _, _ in segments], dtype=np.float64),
+            segment_offsets=np.concatenate(([0], np.cumsum(counts))).astype(np.int64),
+            starts=np.concatenate([starts for _, starts, _, _ in segments]) if segments else np.zeros(0),
+            ends=np.concatenate([ends for _, _, ends, _ in segments]) if segments else np.zeros(0)
+        )
+    os.replace(tmp_path, os.path.join(corpus_path, "index.npz"))
+
+    print(f"\nPacked {num_files} files into {writer.shard + 1} shards, {time.time() - start_time:.2f} secs")
+
+
+# one split of a packed corpus, audio is read through memory maps opened lazily in each worker
+class CorpusData(torch.utils.data.Dataset):
+    def __init__(self, config, split="train"):
+        self.corpus_path = config["corpus"]["path"]
+        with np.load(os.path.join(self.corpus_path, "index.npz")) as data:
+            index = {key: data[key] for key in data.files}
+        if int(index["version"]) != CORPUS_VERSION:
+            raise ValueError(f"corpus version {int(index['version'])} is not {CORPUS_VERSION}, pack it again")
+        if int(index["sample_rate"]) != config["generate"]["sample_rate"]:
+            raise ValueError("corpus sample rate differs from generate.sample_rate, pack it again")
+
+        self.index = index
+        self.dtype = np.dtype(str(index["dtype"]))
+        self.rows = np.flatnonzero(index["split"] == SPLITS.index(split))
+        self.annotate_files = [str(name) for name in index["names"][self.rows]]
+
+        self.windows = AnnotateData(dict(config, use_gpu=False))
+        self.shards = {}
+
+    def __len__(self):
+        return len(self.rows)
+
+    def window_count(self, index):
+        return int(self.index["file_windows"][self.rows[index]])
+
+    def _shard(self, shard):
+        if shard not in self.shards:
+            path = os.path.join(self.corpus_path, f"shard_{shard:04d}.bin")
+            self.shards[shard] = np.memmap(path, dtype=self.dtype, mode="c")
+        return self.shards[shard]
+
+    # a view into the shard, int16 audio is scaled back by AnnotateModule
+    def _audio(self, audio):
+        channels, frames = self.index["audio_channels"][audio], self.index["audio_frames"][audio]
+        offset = self.index["audio_offset"][audio]
+        array = self._shard(int(self.index["audio_shard"][audio]))[offset:offset + channels * frames]
+        return torch.from_numpy(array.reshape(channels, frames))
+
+    def __getitem__(self, index):
+        row = self.rows[index]
+        original_wav = self._audio(self.index["file_original"][row])
+        changed_wav = self._audio(self.index["file_changed"][row])
+
+        lo, hi = self.index["segment_offsets"][row], self.index["segment_offsets"][row + 1]
+        return self.windows.make_windows(
+            original_wav, changed_wav, float(self.index["seconds_per_segment"][row]),
+            torch.from_numpy(self.index["starts"][lo:hi]), torch.from_numpy(self.index["ends"][lo:hi])
+        )
+
+
+if __name__ == "__main__":
+    with open("config.json", "r") as j_file:
+        audio_spliter_config = json.load(j_file)
+
+    pack_corpus(audio_spliter_config)
@@ -1,19 +1,30 @@
-import json
 import os
+import random
+import zlib
 
 import torch
 from torch import nn
 import torch.nn.functional as fn
-import torchaudio
-from torchaudio.transforms import MelSpectrogram, Resample
+
+from annotate_generator import AudioAnnotateGenerator
+from annotate_features import source_stamp
+from annotate_segments import SegmentIndex
+from annotate_transforms import get_window_featurizer
+
+import _paths  # noqa: F401
+from src.AudioCache import SourceAudioCache
+from src.AudioReader import load_resampled
+from src.Rendition import rendition_path
 
 
 class AnnotateData(torch.utils.data.Dataset):
-    def __init__(self, config):
+    def __init__(self, config, feature_store=None):
         self.device = "cuda" if config["use_gpu"] else "cpu"
 
         self.annotate_config = os.path.join(config["path"]["output"], "config")
-        self.annotate_original = os.path.join(config["path"]["output"], "audio_originals")
+        self.youtube_audio_path = config["path"]["youtube_audio"]
+        self.youtube_root_path = os.path.dirname(os.path.normpath(self.youtube_audio_path))
+        self.trim = config["generate"]["trim"]
         self.annotate_wav = os.path.join(config["path"]["output"], "audios")
 
         self.generate_sample_rate = config["generate"]["sample_rate"]
@@ -24,118 +35,234 @@ class AnnotateData(torch.utils.data.Dataset):
         self.n_feats = config["dataset"]["n_feats"]
         self.n_fft = config["dataset"]["n_fft"]
 
-        self.annotate_files = [path[:-5] for path in os.listdir(os.path.join(config["path"]["output"], "config"))
-                               if path.endswith(".json")]
+        self.segment_index = SegmentIndex.load_or_build(
+            self.annotate_config, os.path.join(config["path"]["output"], "segments.npz")
+        )
+        self.annotate_files = self.segment_index.names
+
+        self.feature_store = feature_store
+        self.source_cache = SourceAudioCache(
+            config["path"]["source_cache"], int(config["source_cache"]["max_gigabytes"] * 1024 ** 3)
+        )
 
-    def _log_mel_spec(self, waveform):
-        try:
-            waveform = MelSpectrogram(sample_rate=self.train_sample_rate, n_mels=self.n_feats, n_fft=self.n_fft).to(self.device)(waveform)
-            return torch.log(waveform + 1e-14)
-        except:
-            return None
+    def _featurizer(self, device):
+        return get_window_featurizer(
+            self.generate_sample_rate, self.train_sample_rate, self.n_feats, self.n_fft, device
+        )
 
     def __len__(self):
         return len(self.annotate_files)
 
+    # without a feature store, items are raw windows featurized by AnnotateModule on its device
     def __getitem__(self, index):
+        if self.feature_store is None:
+            return self.load_windows(index)
+
+        features = self.feature_store.load(self.annotate_files[index], source_stamp(self.source_paths(index)))
+        return features if features is not None else self.compute_features(index, "cpu")
+
+    # the original rendition closest to sample_rate, generate_sample_rate by default, and the
+    # changed wav of a generated file
+    def source_paths(self, index, sample_rate=None):
         file_name = self.annotate_files[index]
+        original_path = rendition_path(
+            self.youtube_root_path, file_name[:-3], sample_rate or self.generate_sample_rate,
+            data_path=self.youtube_audio_path
+        )
+        return original_path, os.path.join(self.annotate_wav, file_name + ".wav")
+
+    # original and changed audio of a generated file, at train_sample_rate by default; the original
+    # is read from its rendition closest to sample_rate
+    def load_waveforms(self, index, sample_rate=None, device=None):
+        sample_rate = sample_rate or self.train_sample_rate
+        original_path, wav_path = self.source_paths(index, sample_rate)
+        device = device or self.device
+
+        original_wav = self.source_cache.load(original_path, sample_rate, trim=self.trim, device=device)
+        changed_wav = load_resampled(wav_path, sample_rate).to(device)
+        return original_wav, changed_wav
+
+    # waveform windows at generate_sample_rate, with the featurizer's margins, read on the cpu
+    def load_windows(self, index):
+        seconds_per_segment, starts, ends = self._load_segments(self.annotate_files[index])
+        original_wav, changed_wav = self.load_waveforms(index, self.generate_sample_rate, "cpu")
+
+        return self.make_windows(original_wav, changed_wav, seconds_per_segment, starts, ends)
+
+    # original_wav, changed_wav: [channels, samples] at generate_sample_rate
+    def make_windows(self, original_wav, changed_wav, seconds_per_segment, starts, ends):
+        window_ids, original_ids, y_position, y_state = self.window_targets(starts, ends)
+
+        featurizer = self._featurizer("cpu")
+        original_windows = featurizer.frame(original_wav, seconds_per_segment, seconds_per_segment, original_ids)
+        changed_windows = featurizer.frame(changed_wav, self.seconds_per_item, self.push_seconds, window_ids)
+
+        return original_windows, changed_windows, y_position, y_state
 
-        original_path = os.path.join(self.annotate_original, file_name[:-3] + ".wav")
-        wav_path = os.path.join(self.annotate_wav, file_name + ".wav")
-        config_path = os.path.join(self.annotate_config, file_name + ".json")
-
-        with open(config_path, "r", encoding="utf-8") as file:
-            wav_config = json.load(file)
-
-        original_wav, original_sr = torchaudio.load(original_path)
-        changed_wav, changed_sr = torchaudio.load(wav_path)
-
-        original_wav = original_wav.to(self.device)
-        changed_wav = changed_wav.to(self.device)
-
-        if self.generate_sample_rate != self.train_sample_rate:
-            original_wav = Resample(self.generate_sample_rate, self.train_sample_rate).to(self.device)(original_wav)
-            changed_wav = Resample(self.generate_sample_rate, self.train_sample_rate).to(self.device)(changed_wav)
-
-        x_original = []
-        x_change = []
-        y_position = []
-        y_state = []
-
-        current_secs = 0
-
-        if f"{len(wav_config['segments']) - 1}" not in wav_config["segments"]:
-            wav_config["segments"][f"{len(wav_config['segments']) - 1}"] = wav_config["segments"][
-                f"{len(wav_config['segments'])}"]
-            del wav_config["segments"][f"{len(wav_config['segments']) - 1}"]
-            with open(config_path, "w", encoding="utf-8") as file:
-                json.dump(wav_config, file, indent=2)
-
-        i = 0
-        pass_zero = 0
-        while i < len(wav_config["segments"]) - 1:
-            end_secs = current_secs + self.seconds_per_item
-
-            original_segment = original_wav[
-                               :,
-                               int((i - pass_zero) * wav_config["seconds_per_segment"] * self.train_sample_rate):
-                               int((i + 1 - pass_zero) * wav_config["seconds_per_segment"] * self.train_sample_rate)
-                               ]
-            changed_segment = changed_wav[
-                              :,
-                              int(current_secs * self.train_sample_rate): int(end_secs * self.train_sample_rate)
-                              ]
-
-            if end_secs < wav_config["segments"][f"{i}"]["end"]:
-                if i == 0:
-                    y_position.append(torch.tensor([0.0, 0.0]))
-                    y_state.append(torch.tensor([0.0]))
-                else:
-                    y_start_sec = (wav_config["segments"][f"{i}"]["start"] - current_secs)
-                    y_position.append(torch.tensor([y_start_sec / self.seconds_per_item, 0.0]))
-                    y_state.append(torch.tensor([self.seconds_per_item - y_start_sec]))
-                i -= 1
-                current_secs += self.push_seconds
-            else:
-                if i == 0:
-                    i += 1
-                    pass_zero = 1
-                    continue
-                y_start_sec = (wav_config["segments"][f"{i}"]["start"] - current_secs)
-                y_end_sec = (wav_config["segments"][f"{i}"]["end"] - current_secs)
-                y_position.append(torch.tensor([y_start_sec / self.seconds_per_item, y_end_sec / self.seconds_per_item]))
-                y_state.append(torch.tensor([1.0]))
-
-            x_original_check = self._log_mel_spec(original_segment)
-            x_change_check = self._log_mel_spec(changed_segment)
-
-            x_original.append(x_original_check.to("cpu") if x_original_check is not None else torch.zeros_like(x_original[-1]))
-            x_change.append(x_change_check.to("cpu") if x_change_check is not None else torch.zeros_like(x_change[-1]))
-
-            i += 1
+    def compute_features(self, index, device=None):
+        device = device or self.device
+        original_windows, changed_windows, y_position, y_state = self.load_windows(index)
+
+        featurizer = self._featurizer(device)
+        x_original = featurizer(original_windows.to(device)).to("cpu")
+        x_change = featurizer(changed_windows.to(device)).to("cpu")
 
         return x_original, x_change, y_position, y_state
 
+    def _load_segments(self, file_name):
+        seconds_per_segment, starts, ends, _ = self.segment_index[file_name]
+        return seconds_per_segment, torch.from_numpy(starts), torch.from_numpy(ends)
+
+    def window_count(self, index):
+        file_name = self.annotate_files[index]
+        if self.feature_store is not None and self.feature_store.fresh(
+                file_name, source_stamp(self.source_paths(index))):
+            return self.feature_store.window_count(file_name)
+
+        _, starts, ends = self._load_segments(file_name)
+        return len(self.window_targets(starts, ends)[0])
+
+    def window_targets(self, starts, ends):
+        # starts/ends hold the empty start, the changed segments and the empty end, in order.
+        # The changed audio is read with windows of seconds_per_item pushed by push_seconds;
+        # a window is emitted for every segment that does not fit yet (partial) and once the
+        # segment fits entirely (full), then the next segment is tried on the same window.
+        num_segments = len(starts) - 1
+        last_windows = torch.ceil((ends[:num_segments] - self.seconds_per_item) / self.push_seconds)
+        last_windows = last_windows.clamp(min=0).long()
+
+        first_windows = torch.cat((torch.zeros(1, dtype=torch.long), last_windows[:-1]))
+        counts = last_windows - first_windows + 1
+        counts[0] = last_windows[0]
+
+        segment_ids = torch.repeat_interleave(torch.arange(num_segments), counts)
+        offsets = torch.arange(len(segment_ids)) - torch.repeat_interleave(torch.cumsum(counts, 0) - counts, counts)
+        window_ids = first_windows[segment_ids] + offsets
+
+        is_empty = segment_ids == 0
+        is_full = (offsets == counts[segment_ids] - 1) & ~is_empty
+
+        window_secs = window_ids.double() * self.push_seconds
+        y_start_sec = starts[segment_ids] - window_secs
+        y_end_sec = ends[segment_ids] - window_secs
+
+        y_position = torch.stack((
+            torch.where(is_empty, 0.0, y_start_sec / self.seconds_per_item),
+            torch.where(is_full, y_end_sec / self.seconds_per_item, 0.0)
+        ), dim=1)
+        y_state = torch.where(is_full, 1.0, self.seconds_per_item - y_start_sec)
+        y_state = torch.where(is_empty, 0.0, y_state).unsqueeze(1)
+
+        original_ids = (segment_ids - 1).clamp(min=0)
+
+        return window_ids, original_ids, y_position.float(), y_state.float()
+
+
+# generated items rendered on the fly from the cached originals instead of read from disk: the
+# generator's padding, split, speed change and noise run in the dataloader workers, seeded by
+# (split, epoch, item), and the targets come from the segment config in memory. Splits without
+# originals of their own draw from the train originals with their own seeds
+class AugmentedAnnotateData(torch.utils.data.IterableDataset):
+    def __init__(self, config, video_ids, num_items, split="train"):
+        super().__init__()
+        config = dict(config, use_gpu=False)
+        self.video_ids = video_ids
+        self.num_items = num_items
+        self.split = split
+        self.seed = config["generate"]["seed"]
+        self.epoch = 0
+
+        self.windows = AnnotateData(config)
+        self.generator = AudioAnnotateGenerator(config)
+
+    def set_epoch(self, epoch):
+        self.epoch = epoch
+
+    def __len__(self):
+        return self.num_items
+
+    def item_seed(self, index):
+        return zlib.crc32(f"{self.seed}_{self.split}_{self.epoch}_{index}".encode("utf-8"))
+
+    def generate_item(self, index):
+        video_id = self.video_ids[index % len(self.video_ids)]
+        self.generator.rng.manual_seed(self.item_seed(index))
+
+        original_wav = self.generator._load_audio(video_id)
+        changed_wav, (starts, ends, _) = self.generator._generate_audio(original_wav)
+
+        return self.windows.make_windows(
+            original_wav, changed_wav, self.generator.seconds_per_segment,
+            torch.from_numpy(starts), torch.from_numpy(ends)
+        )
+
+    def __iter__(self):
+        indices = list(range(self.num_items))
+        if self.split == "train":
+            random.Random(self.item_seed(-1)).shuffle(indices)
+
+        worker = torch.utils.data.get_worker_info()
+        if worker is not None:
+            indices = indices[worker.id::worker.num_workers]
+
+        for index in indices:
+            yield self.generate_item(index)
+
+
+# batches of items with similar window counts, shuffled within pools of
+# batch_size * pool_batches items so batches stay random between epochs; the order only depends
+# on seed and the epoch AnnotateModule sets when a training epoch starts
+class BucketBatchSampler(torch.utils.data.Sampler):
+    def __init__(self, lengths, batch_size, shuffle=True, pool_batches=50, seed=0):
+        super().__init__()
+        self.lengths = lengths
+        self.batch_size = batch_size
+        self.shuffle = shuffle
+        self.pool_size = batch_size * pool_batches
+        self.seed = seed
+        self.epoch = 0
+
+    def set_epoch(self, epoch):
+        self.epoch = epoch
+
+    def _batches(self):
+        indices = list(range(len(self.lengths)))
+        rng = random.Random(self.seed + self.epoch)
+        if self.shuffle:
+            rng.shuffle(indices)
+
+        batches = []
+        for i in range(0, len(indices), self.pool_size):
+            pool = sorted(indices[i: i + self.pool_size], key=lambda index: self.lengths[index])
+            batches.extend([pool[j: j + self.batch_size] for j in range(0, len(pool), self.batch_size)])
+
+        if self.shuffle:
+            rng.shuffle(batches)
+        return batches
+
+    def __iter__(self):
+        return iter(self._batches())
+
+    def __len__(self):
+        return (len(self.lengths) + self.batch_size - 1) // self.batch_size
+
 
+# items are either features [windows, channels, n_feats, frames] or raw windows [windows, channels, samples]
 def collect_fn(data):
-    x_originals = []
-    x_changes = []
-    y_positions = []
-    y_states = []
+    x_original_max = max([x_original.size(-1) for x_original, _, _, _ in data])
+    x_change_max = max([x_change.size(-1) for _, x_change, _, _ in data])
 
-    for (x_original, x_change, y_position, y_state) in data:
-        x_original_max = max([item.size(2) for item in x_original])
-        x_change_max = max([item.size(2) for item in x_change])
-        x_originals.append(torch.stack([fn.pad(item, (0, x_original_max - item.size(2))) for item in x_original]))
-        x_changes.append(torch.stack([fn.pad(item, (0, x_change_max - item.size(2))) for item in x_change]))
-        y_positions.append(torch.stack(y_position))
-        y_states.append(torch.stack(y_state))
+    x_originals = [fn.pad(x_original, (0, x_original_max - x_original.size(-1))) for x_original, _, _, _ in data]
+    x_changes = [fn.pad(x_change, (0, x_change_max - x_change.size(-1))) for _, x_change, _, _ in data]
+    y_positions = [y_position for _, _, y_position, _ in data]
+    y_states = [y_state for _, _, _, y_state in data]
 
-    max_len = max([len(item) for item in y_states])
+    lengths = torch.tensor([len(item) for item in y_states])
+    max_len = int(lengths.max())
 
     x_originals = torch.nn.utils.rnn.pad_sequence(x_originals, batch_first=True, padding_value=0)
     x_changes = torch.nn.utils.rnn.pad_sequence(x_changes, batch_first=True, padding_value=0)
     y_positions = torch.nn.utils.rnn.pad_sequence(y_positions, batch_first=True, padding_value=0)
     y_states = torch.nn.utils.rnn.pad_sequence(y_states, batch_first=True, padding_value=0)
 
-    return x_originals, x_changes, y_positions, y_states, len(y_states), max_len
+    return x_originals, x_changes, y_positions, y_states, len(y_states), max_len, lengths
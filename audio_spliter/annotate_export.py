@@ -0,0 +1,169 @@
+import json
+import math
+import os
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import torch
+from torch import nn
+from torchaudio.transforms import MelSpectrogram
+
+from annotate_model import Annotater, progression_pairs, refine_pairs, step_boundaries
+from annotate_transforms import frame_waveform
+
+
+# settings the runtime needs to frame audio for an exported model, saved inside the artifact
+def window_settings(config):
+    return {
+        "train_sample_rate": config["dataset"]["train_sample_rate"],
+        "seconds_per_segment": config["generate"]["seconds_per_segment"],
+        "seconds_per_item": config["dataset"]["seconds_per_item"],
+        "push_seconds": config["dataset"]["push_seconds"]
+    }
+
+
+# original, cover: [channels, samples] at train_sample_rate, framed as in Annotater.annotate:
+# every segment of the original and every window of the cover
+def frame_windows(original, cover, settings):
+    sample_rate = settings["train_sample_rate"]
+    segment_frames = int(settings["seconds_per_segment"] * sample_rate)
+    item_frames = int(settings["seconds_per_item"] * sample_rate)
+    push_frames = int(settings["push_seconds"] * sample_rate)
+
+    num_windows = max(1, math.ceil((cover.size(-1) - item_frames) / push_frames) + 1)
+    num_segments = max(1, math.ceil(original.size(-1) / segment_frames))
+
+    original_windows = frame_waveform(original, segment_frames, segment_frames, torch.arange(num_segments))
+    cover_windows = frame_waveform(cover, item_frames, push_frames, torch.arange(num_windows))
+    return original_windows, cover_windows
+
+
+# the paired windows of the steps progression_pairs makes of completed, and their window ids
+def frame_pairs(original, cover, settings, completed=()):
+    original_windows, cover_windows = frame_windows(original, cover, settings)
+    step_windows, step_segments = progression_pairs(len(cover_windows), len(original_windows), completed)
+    return original_windows[step_segments], cover_windows[step_windows], step_windows
+
+
+# paired waveform windows in, per window outputs out; owns its MelSpectrogram so the traced
+# artifact needs nothing from the training code
+class AnnotateInference(nn.Module):
+    def __init__(self, annotater):
+        super().__init__()
+        self.annotater = annotater
+        self.mel_spectrogram = MelSpectrogram(
+            sample_rate=annotater.train_sample_rate, n_mels=annotater.n_feats, n_fft=annotater.n_fft
+        )
+
+    # original_windows: [windows, channels, segment samples], cover_windows: [windows, channels, item samples]
+    def forward(self, original_windows, cover_windows):
+        x1 = torch.log(self.mel_spectrogram(original_windows) + 1e-14)
+        x2 = torch.log(self.mel_spectrogram(cover_windows) + 1e-14)
+        y_position, y_state, _ = self.annotater.forward_sequence(x1.unsqueeze(0), x2.unsqueeze(0))
+        return y_position[0], y_state[0]
+
+
+# lightning checkpoints keep the model under "annotater.", next to the featurizer
+def load_annotater(config, checkpoint_path=None):
+    annotater = Annotater(config)
+    if checkpoint_path is not None:
+        state_dict = torch.load(checkpoint_path, map_location="cpu")
+        if "state_dict" in state_dict:
+            state_dict = {
+                key[len("annotater."):]: value for key, value in state_dict["state_dict"].items()
+                if key.startswith("annotater.")
+            }
+        annotater.load_state_dict(state_dict)
+    return annotater.eval()
+
+
+# linear and lstm weights to int8, activations are quantized on the fly per batch
+def quantize_annotater(annotater):
+    return torch.ao.quantization.quantize_dynamic(annotater, {nn.Linear, nn.LSTM}, dtype=torch.qint8)
+
+
+def example_windows(config, num_windows=4):
+    settings = window_settings(config)
+    sample_rate = settings["train_sample_rate"]
+    return (
+        torch.zeros(num_windows, 1, int(settings["seconds_per_segment"] * sample_rate)),
+        torch.zeros(num_windows, 1, int(settings["seconds_per_item"] * sample_rate))
+    )
+
+
+def build_inference(config, checkpoint_path=None, quantize=True):
+    annotater = load_annotater(config, checkpoint_path)
+    if quantize:
+        annotater = quantize_annotater(annotater)
+    return AnnotateInference(annotater).eval()
+
+
+# traced and frozen TorchScript, ONNX has no export for dynamically quantized lstm
+@torch.no_grad()
+def export_annotater(config, path, checkpoint_path=None, quantize=True):
+    module = build_inference(config, checkpoint_path, quantize)
+    traced = torch.jit.freeze(torch.jit.trace(module, example_windows(config)))
+
+    if os.path.dirname(path) and not os.path.isdir(os.path.dirname(path)):
+        os.makedirs(os.path.dirname(path))
+    tmp_path = path + ".tmp"
+    torch.jit.save(traced, tmp_path, _extra_files={"window_settings.json": json.dumps(window_settings(config))})
+    os.replace(tmp_path, path)
+    return traced
+
+
+# runs an exported artifact on cpu; torch's intra-op pool is process wide, so num_workers
+# concurrent requests each get intra_op_threads threads. The artifact runs whole sequences, so
+# windows are paired with original segments by refine_pairs, in at most max_passes runs
+class AnnotateRuntime:
+    def __init__(self, artifact_path, num_workers=1, intra_op_threads=None, max_passes=8):
+        extra_files = {"window_settings.json": ""}
+        self.module = torch.jit.load(artifact_path, map_location="cpu", _extra_files=extra_files)
+        self.settings = json.loads(extra_files["window_settings.json"])
+        self.max_passes = max_passes
+
+        self.intra_op_threads = intra_op_threads or max(1, (os.cpu_count() or 1) // num_workers)
+        torch.set_num_threads(self.intra_op_threads)
+        self.executor = ThreadPoolExecutor(num_workers)
+
+    @torch.no_grad()
+    def forward_windows(self, original, cover, threshold=0.5):
+        original_windows, cover_windows = frame_windows(original, cover, self.settings)
+
+        def run(step_windows, step_segments):
+            return self.module(original_windows[step_segments], cover_windows[step_windows])
+
+        step_windows, y_position, y_state = refine_pairs(
+            run, len(cover_windows), len(original_windows), threshold, self.max_passes
+        )
+        return y_position, y_state, step_windows
+
+    def annotate(self, original, cover, threshold=0.5):
+        y_position, y_state, step_windows = self.forward_windows(original, cover, threshold)
+        return step_boundaries(
+            y_position, y_state, step_windows, self.settings["push_seconds"], self.settings["seconds_per_item"], threshold
+        )
+
+    def submit(self, original, cover, threshold=0.5):
+        return self.executor.submit(self.annotate, original, cover, threshold)
+
+    def close(self):
+        self.executor.shutdown()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+
+if __name__ == "__main__":
+    with open("config.json", "r") as j_file:
+        audio_spliter_config = json.load(j_file)
+
+    export_config = audio_spliter_config["export"]
+    start_time = time.time()
+    export_annotater(
+        audio_spliter_config, export_config["path"], export_config["checkpoint"], export_config["quantize"]
+    )
+    print(f"Exported {export_config['path']}, {time.time() - start_time:.2f} secs")
@@ -0,0 +1,104 @@
+import hashlib
+import json
+import os
+import shutil
+import time
+
+import numpy as np
+import torch
+
+FEATURE_STORE_VERSION = 5
+
+
+def feature_config_hash(config):
+    values = json.dumps({"dataset": config["dataset"], "generate": config["generate"]}, sort_keys=True)
+    return hashlib.sha1(values.encode("utf-8")).hexdigest()[:16]
+
+
+# size and mtime of every file the features of a generated file are computed from
+def source_stamp(paths):
+    return [[os.stat(path).st_size, os.stat(path).st_mtime_ns] for path in paths]
+
+
+# one .npy shard per array and generated file, stored under a directory named after the
+# store version and the dataset/generate config hash, so a config change rebuilds the store.
+# Every file is indexed with the source_stamp of its audio, a regenerated or re-downloaded wav
+# makes its features stale
+class AnnotateFeatureStore:
+    def __init__(self, config):
+        self.config_hash = feature_config_hash(config)
+        self.features_path = os.path.join(config["path"]["output"], "features")
+        self.store_path = os.path.join(self.features_path, f"v{FEATURE_STORE_VERSION}_{self.config_hash}")
+        self.index_path = os.path.join(self.store_path, "index.json")
+
+        self.index = self._load_index()
+
+    def _load_index(self):
+        if os.path.exists(self.index_path):
+            with open(self.index_path, "r", encoding="utf-8") as file:
+                return json.load(file)
+        return {"version": FEATURE_STORE_VERSION, "config_hash": self.config_hash, "files": {}}
+
+    def _save_index(self):
+        tmp_path = self.index_path + ".tmp"
+        with open(tmp_path, "w", encoding="utf-8") as file:
+            json.dump(self.index, file, indent=2)
+        os.replace(tmp_path, self.index_path)
+
+    def _shard_path(self, file_name, name):
+        return os.path.join(self.store_path, f"{file_name}.{name}.npy")
+
+    def _save_shard(self, file_name, name, array):
+        tmp_path = self._shard_path(file_name, name) + ".tmp"
+        with open(tmp_path, "wb") as file:
+            np.save(file, array)
+        os.replace(tmp_path, self._shard_path(file_name, name))
+
+    def _remove_stale_stores(self):
+        for path in os.listdir(self.features_path):
+            if path != os.path.basename(self.store_path):
+                shutil.rmtree(os.path.join(self.features_path, path), ignore_errors=True)
+
+    def fresh(self, file_name, stamp):
+        entry = self.index["files"].get(file_name)
+        return entry is not None and entry.get("sources") == stamp
+
+    def window_count(self, file_name):
+        return self.index["files"][file_name]["windows"]
+
+    def build(self, dataset, save_every=16):
+        if not os.path.isdir(self.store_path):
+            os.makedirs(self.store_path)
+        self._remove_stale_stores()
+
+        stamps = [source_stamp(dataset.source_paths(index)) for index in range(len(dataset.annotate_files))]
+        missing = [
+            index for index, file_name in enumerate(dataset.annotate_files) if not self.fresh(file_name, stamps[index])
+        ]
+        start_time = time.time()
+        for count, index in enumerate(missing):
+            file_name = dataset.annotate_files[index]
+            print(f"Featurizing audios, {count + 1}/{len(missing)}, current: {file_name}", end="\r")
+
+            x_original, x_change, y_position, y_state = dataset.compute_features(index)
+            self._save_shard(file_name, "original", x_original.to("cpu").numpy())
+            self._save_shard(file_name, "change", x_change.to("cpu").numpy())
+            self._save_shard(file_name, "targets", torch.cat((y_position, y_state), dim=1).to("cpu").numpy())
+            self.index["files"][file_name] = {"windows": int(y_state.size(0)), "sources": stamps[index]}
+
+            if (count + 1) % save_every == 0:
+                self._save_index()
+
+        self._save_index()
+        if missing:
+            print(f"Featurize done, {len(missing)} files, {time.time() - start_time:.2f} secs")
+
+    def load(self, file_name, stamp):
+        if not self.fresh(file_name, stamp):
+            return None
+
+        x_original = np.load(self._shard_path(file_name, "original"), mmap_mode="c")
+        x_change = np.load(self._shard_path(file_name, "change"), mmap_mode="c")
+        targets = torch.from_numpy(np.load(self._shard_path(file_name, "targets"), mmap_mode="c"))
+
+        return torch.from_numpy(x_original), torch.from_numpy(x_change), targets[:, :2], targets[:, 2:]
@@ -1,41 +1,68 @@
 import json
 import os
-import threading
 import time
-from concurrent.futures import ProcessPoolExecutor
+import zlib
+from concurrent.futures import ProcessPoolExecutor, as_completed
 
+import numpy as np
+import soundfile
 import torch
-import torchaudio
-import torchaudio.transforms as transforms
-import torch.nn.functional as F
-from torch.multiprocessing import Pool, set_start_method
-from torchaudio.transforms import Resample, TimeStretch
-import os
-import subprocess
+from torch.multiprocessing import get_context
+
+from annotate_segments import EMPTY_END, EMPTY_START, SegmentIndex, load_segments, save_segments, segment_files
+from annotate_transforms import get_resample
+
+import _paths  # noqa: F401
+from src.AudioCache import SourceAudioCache
+from src.Rendition import rendition_path, video_ids
 
 # AUDIO_TEST_ORIGINAL_ID = "-pHfPJGatgE"
 # AUDIO_TEST_COVER_ID = "w-tYngyVXLM"
 
 
+_generate_worker = None
+
+
+def _init_generate_worker(config):
+    global _generate_worker
+    torch.set_num_threads(1)
+    _generate_worker = AudioAnnotateGenerator(config)
+
+
+def _generate_video(video_id, generate_ids):
+    return [_generate_worker._safe_generate_file(video_id, generate_id) for generate_id in generate_ids]
+
+
 class AudioAnnotateGenerator:
     def __init__(self, config):
-        set_start_method('spawn')
-
+        self.config = config
         self.device = "cuda" if config["use_gpu"] else "cpu"
         self.youtube_audio_path = config["path"]["youtube_audio"]
+        # the downloads keep their per video json, with the registered renditions, next to data
+        self.youtube_root_path = os.path.dirname(os.path.normpath(self.youtube_audio_path))
         self.generates_per_audio = config["generate"]["numbers_per_audio"]
         self.generate_sample_rate = config["generate"]["sample_rate"]
         self.generate_max_padding_seconds = config["generate"]["max_padding_seconds"]
         self.generate_speed_range = config["generate"]["speed_range"]
+        self.speed_grid_step = config["generate"]["speed_grid_step"]
         self.noise_amplitude = config["generate"]["noise_amplitude"]
         self.seconds_per_segment = config["generate"]["seconds_per_segment"]
+        self.seed = config["generate"]["seed"]
+        self.trim = config["generate"]["trim"]
+        self.rng = torch.Generator()
 
-        self.speed_resample_num_workers = config["speed_resample_thread"]["num_workers"]
-        self.speed_resample_batch_size = config["speed_resample_thread"]["batch_size"]
+        self.source_cache = SourceAudioCache(
+            config["path"]["source_cache"], int(config["source_cache"]["max_gigabytes"] * 1024 ** 3)
+        )
 
         self.output_wav = os.path.join(config["path"]["output"], "audios")
         self.output_config = os.path.join(config["path"]["output"], "config")
-        self.output_original = os.path.join(config["path"]["output"], "audio_originals")
+        self.manifest_path = os.path.join(config["path"]["output"], "manifest.jsonl")
+        self.segment_index_path = os.path.join(config["path"]["output"], "segments.npz")
+
+        self.num_workers = config["generate_thread"]["num_workers"]
+        if self.num_workers is None:
+            self.num_workers = os.cpu_count()
 
         self.max_len = config["dataset"]["num_data"]
 
@@ -46,104 +73,162 @@ class AudioAnnotateGenerator:
             os.makedirs(self.output_wav)
         if not os.path.isdir(self.output_config):
             os.makedirs(self.output_config)
-        if not os.path.isdir(self.output_original):
-            os.makedirs(self.output_original)
 
-        generated_paths = os.listdir(self.output_config)
+        generated_names = self.load_manifest()
         audio_paths = []
 
-        for file_path in os.listdir(self.youtube_audio_path):
-            if file_path.endswith(".wav"):
-                video_id = file_path[:-4]
-                for i in range(self.generates_per_audio):
-                    if f"{video_id}_{str(i + 1).zfill(2)}.json" in generated_paths:
-                        continue
-                    audio_paths.append((video_id, i + 1))
+        for video_id in video_ids(self.youtube_audio_path):
+            for i in range(self.generates_per_audio):
+                if self.generate_name(video_id, i + 1) in generated_names:
+                    continue
+                audio_paths.append((video_id, i + 1))
+
+        return generated_names, audio_paths
+
+    def load_manifest(self):
+        if not os.path.exists(self.manifest_path):
+            # outputs from before the manifest existed count as done when they are complete
+            names = [name for name, file_name in segment_files(self.output_config).items()
+                     if self._output_complete(name, file_name)]
+            with open(self.manifest_path, "w", encoding="utf-8") as file:
+                for name in names:
+                    file.write(json.dumps({"name": name}) + "\n")
+
+        with open(self.manifest_path, "r", encoding="utf-8") as file:
+            return {json.loads(line)["name"] for line in file if line.strip()}
+
+    # the wav exists and is as long as its segments say, a killed run can leave segments whose
+    # audio is missing or cut short
+    def _output_complete(self, name, file_name):
+        wav_path = os.path.join(self.output_wav, f"{name}.wav")
+        if not os.path.exists(wav_path):
+            return False
+        try:
+            _, _, ends, _ = load_segments(os.path.join(self.output_config, file_name))
+            info = soundfile.info(wav_path)
+        except Exception:
+            return False
+        return info.samplerate == self.generate_sample_rate and len(ends) > 0 \
+            and abs(info.frames - round(float(ends[-1]) * self.generate_sample_rate)) <= 1
 
-        return audio_paths
+    @staticmethod
+    def generate_name(video_id, generate_id):
+        return f"{video_id}_{str(generate_id).zfill(2)}"
 
     def start_generates(self):
-        audio_paths = self._load_audio_paths()
-        last_est = "nan"
+        generated_names, audio_paths = self._load_audio_paths()
+        audio_paths = audio_paths[:max(0, self.max_len - len(generated_names))]
+        if not audio_paths:
+            print("Total generate done!")
+            return
+
+        num_done, num_failed, audio_seconds = len(generated_names), 0, 0.0
+        start_time = time.time()
+
+        with open(self.manifest_path, "a", encoding="utf-8") as manifest:
+            for name, seconds, error in self._run_generates(audio_paths):
+                if error is not None:
+                    num_failed += 1
+                    print(f"\nGenerate {name} failed: {error}")
+                    continue
+
+                manifest.write(json.dumps({"name": name, "seconds": seconds}) + "\n")
+                manifest.flush()
+
+                num_done += 1
+                audio_seconds += seconds
+                elapsed = time.time() - start_time
+                print(f"Generating audios, {num_done}/{self.max_len}, current: {name}, "
+                      f"{(num_done - len(generated_names)) / elapsed:.2f} files/s, "
+                      f"{audio_seconds / elapsed:.1f} audio secs/s", end="\r")
+
+        SegmentIndex.from_directory(self.output_config).save(self.segment_index_path)
+
+        print(f"\nTotal generate done! {num_done}/{self.max_len}, failed: {num_failed}, "
+              f"{time.time() - start_time:.2f} secs")
+
+    def _run_generates(self, audio_paths):
+        if self.num_workers == 0:
+            for video_id, generate_id in audio_paths:
+                yield self._safe_generate_file(video_id, generate_id)
+            return
+
+        # the files of a video run in one worker, so its source is decoded once instead of by
+        # several workers at the same time
+        video_jobs = {}
         for video_id, generate_id in audio_paths:
-            if len(os.listdir(self.output_config)) > self.max_len:
-                print("Total generate done!")
-                break
-            print(f"Generating audios, {len(os.listdir(self.output_config))}/{self.max_len}, current: {video_id}_{str(generate_id).zfill(2)}, last_ext: {last_est}", end="\r")
-            start_time = time.time()
-            # print(f"Generating {video_id}_{str(generate_id).zfill(2)}...")
-            waveform = self._load_audio(video_id)
-            waveform, segment_config = self._generate_audio(waveform)
-
-            config = {
-                "seconds_per_segment": self.seconds_per_segment,
-                "segments": segment_config
-            }
-
-            self.save_config(config, os.path.join(self.output_config, f"{video_id}_{str(generate_id).zfill(2)}.json"))
-            self.save_audio(waveform, os.path.join(self.output_wav, f"{video_id}_{str(generate_id).zfill(2)}.wav"))
-
-            last_est = "{:.2f} secs".format(time.time() - start_time)
-            # print(f"Done Generate {video_id}_{str(generate_id).zfill(2)}, ext: {last_est}")
+            video_jobs.setdefault(video_id, []).append(generate_id)
+
+        # workers run on the cpu, a cuda context per worker would exhaust the gpu memory
+        with ProcessPoolExecutor(
+                max_workers=min(self.num_workers, len(video_jobs)), mp_context=get_context("spawn"),
+                initializer=_init_generate_worker, initargs=(dict(self.config, use_gpu=False),)
+        ) as executor:
+            futures = [
+                executor.submit(_generate_video, video_id, generate_ids) for video_id, generate_ids in video_jobs.items()
+            ]
+            for future in as_completed(futures):
+                yield from future.result()
+
+    def _safe_generate_file(self, video_id, generate_id):
+        try:
+            return self.generate_file(video_id, generate_id)
+        except Exception as e:
+            return self.generate_name(video_id, generate_id), 0.0, repr(e)
+
+    def generate_file(self, video_id, generate_id):
+        name = self.generate_name(video_id, generate_id)
+
+        self.seed_generate(video_id, generate_id)
+        waveform = self._load_audio(video_id)
+        waveform, (starts, ends, flags) = self._generate_audio(waveform)
+
+        # the segments are written last, their presence marks a complete output
+        self.save_audio(waveform, os.path.join(self.output_wav, f"{name}.wav"))
+        save_segments(os.path.join(self.output_config, f"{name}.npz"), self.seconds_per_segment, starts, ends, flags)
+
+        return name, waveform.shape[-1] / self.generate_sample_rate, None
 
     def _load_audio(self, video_id):
-        if os.path.exists(os.path.join(self.output_original, f"{video_id}.wav")):
-            waveform, _ = torchaudio.load(os.path.join(self.output_original, f"{video_id}.wav"))
-            waveform = waveform.to(self.device)
-        else:
-            waveform, sr = torchaudio.load(os.path.join(self.youtube_audio_path, f"{video_id}.wav"))
-            waveform = waveform.to(self.device)
-            waveform = self.trim_empty(waveform)
-            waveform = Resample(44100, self.generate_sample_rate).to(self.device)(waveform)
-            self.save_audio(waveform, os.path.join(self.output_original, f"{video_id}.wav"))
-
-        return waveform
+        return self.source_cache.load(
+            rendition_path(
+                self.youtube_root_path, video_id, self.generate_sample_rate, data_path=self.youtube_audio_path
+            ),
+            self.generate_sample_rate, trim=self.trim, device=self.device
+        )
+
+    def seed_generate(self, video_id, generate_id):
+        self.rng.manual_seed(zlib.crc32(f"{self.seed}_{video_id}_{generate_id}".encode("utf-8")))
 
     def _generate_audio(self, waveform):
         start, end = self.get_padding(waveform)
 
         waveform_segments = self.split_audio(waveform, self.seconds_per_segment)
         waveform_segments = self.change_segments_speed(waveform_segments)
-        segment_config = self.generate_segment_config(waveform_segments, start, end)
+        segments = self.generate_segments(waveform_segments, start, end)
         waveform = self.combine_segments(waveform_segments)
         waveform = self.cat_padding(waveform, start, end)
         waveform = self.add_noise(waveform)
 
-        return waveform, segment_config
+        return waveform, segments
 
     def save_audio(self, waveform, path):
-        torchaudio.save(path, waveform.to("cpu"), self.generate_sample_rate)
-
-    @staticmethod
-    def save_config(segment_config, path):
-        with open(path, "w") as file:
-            json.dump(segment_config, file, indent=2)
-
-    @staticmethod
-    def trim_empty(waveform):
-        energy = waveform.pow(2).sum(0)
-
-        start_idx = (energy > 0).nonzero(as_tuple=False).min()
-        end_idx = (energy > 0).nonzero(as_tuple=False).max()
-
-        return waveform[:, start_idx:end_idx + 1]
-
-    @staticmethod
-    def mix_waveform(waveform):
-        return torch.mean(waveform, dim=0, keepdim=True)
+        tmp_path = path + ".tmp"
+        soundfile.write(tmp_path, waveform.to("cpu").numpy().T, self.generate_sample_rate, format="WAV", subtype="FLOAT")
+        os.replace(tmp_path, path)
 
     def get_padding(self, waveform):
-        start, end = int(torch.rand(1) * self.generate_max_padding_seconds * self.generate_sample_rate), \
-            int(torch.rand(1) * self.generate_max_padding_seconds * self.generate_sample_rate)
+        start, end = int(torch.rand(1, generator=self.rng) * self.generate_max_padding_seconds * self.generate_sample_rate), \
+            int(torch.rand(1, generator=self.rng) * self.generate_max_padding_seconds * self.generate_sample_rate)
         return start, end
 
     def cat_padding(self, waveform, start, end):
-        start_frame, end_frame = torch.zeros(waveform.ndim, start).to(self.device), \
-            torch.zeros(waveform.ndim, end).to(self.device)
+        start_frame, end_frame = torch.zeros(waveform.shape[0], start).to(self.device), \
+            torch.zeros(waveform.shape[0], end).to(self.device)
         return torch.cat((start_frame, waveform, end_frame), dim=-1)
 
     def add_noise(self, waveform):
-        waveform += (torch.randn_like(waveform) * self.noise_amplitude)
+        waveform += (torch.randn(waveform.shape, generator=self.rng).to(self.device) * self.noise_amplitude)
         return torch.clamp(waveform, min=-1.0, max=1.0)
 
     def split_audio(self, waveform, seconds_per_segment):
@@ -152,56 +237,40 @@ class AudioAnnotateGenerator:
             segments.append(waveform[:, i: i + int(self.generate_sample_rate * seconds_per_segment)])
         return segments
 
-    def change_speed(self, waveform, log=None):
-        if log is not None:
-            print(log)
+    def random_speeds(self, num_speeds):
+        return (1 - self.generate_speed_range / 2) + torch.rand(num_speeds, generator=self.rng) * self.generate_speed_range
 
-        speed = (1 - self.generate_speed_range / 2) + torch.rand(1) * self.generate_speed_range
-        resample = Resample(self.generate_sample_rate, self.generate_sample_rate // speed).to(self.device)
-        return resample(waveform)
-
-    def _change_segments_speed(self, waveform_segments):
-        waveform_segments = [segment.to(self.device) for segment in waveform_segments]
-        changed_segments = [self.change_speed(segment) for segment in waveform_segments]
-        return [segment.to("cpu") for segment in changed_segments]
+    def speed_sample_rate(self, speed):
+        # snap to a grid of sample_rate * speed_grid_step so the resample kernels stay small and get reused
+        step = max(1, round(self.generate_sample_rate * self.speed_grid_step))
+        return int(round(self.generate_sample_rate / float(speed) / step)) * step
 
     def change_segments_speed(self, waveform_segments):
-        waveform_segments = [segment.to("cpu") for segment in waveform_segments]
-        batches = [waveform_segments[i: i+self.speed_resample_batch_size]
-                   for i in range(0, len(waveform_segments), self.speed_resample_batch_size)]
+        speeds = self.random_speeds(len(waveform_segments))
 
-        with Pool(self.speed_resample_num_workers) as pool:
-            resampled_batches = pool.map(self._change_segments_speed, batches)
+        # segments sharing a snapped rate and length go through one resample call as a batch
+        groups = {}
+        for i, (segment, speed) in enumerate(zip(waveform_segments, speeds)):
+            groups.setdefault((self.speed_sample_rate(speed), segment.shape[-1]), []).append(i)
 
-        resampled_segments = []
-        for batch in resampled_batches:
-            resampled_segments.extend([segment.to(self.device) for segment in batch])
+        resampled_segments = [None] * len(waveform_segments)
+        for (sample_rate, _), indices in groups.items():
+            batch = torch.stack([waveform_segments[i] for i in indices]).to(self.device)
+            resampled = get_resample(self.generate_sample_rate, sample_rate, batch.dtype, self.device)(batch)
+            for i, segment in zip(indices, resampled):
+                resampled_segments[i] = segment
 
         return resampled_segments
 
-    def generate_segment_config(self, waveform_segments, start, end):
-        segment_config = {
-            "0": {
-                "start": 0,
-                "end": start / self.generate_sample_rate,
-                "#": "empty start"
-            }
-        }
-        current_frames = start
-        for i, segment in enumerate(waveform_segments):
-            segment_config[str(i + 1)] = {
-                "start": current_frames / self.generate_sample_rate,
-                "end": (current_frames + segment.shape[-1]) / self.generate_sample_rate,
-            }
-            current_frames += segment.shape[-1]
-
-        segment_config[str(len(waveform_segments) + 1)] = {
-            "start": current_frames / self.generate_sample_rate,
-            "end": (current_frames + end) / self.generate_sample_rate,
-            "#": "empty end"
-        }
-
-        return segment_config
+    # start and end seconds of the empty start, every changed segment and the empty end
+    def generate_segments(self, waveform_segments, start, end):
+        lengths = np.array([start] + [segment.shape[-1] for segment in waveform_segments] + [end], dtype=np.int64)
+        bounds = np.concatenate(([0], np.cumsum(lengths)))
+
+        flags = np.zeros(len(lengths), dtype=np.uint8)
+        flags[0], flags[-1] = EMPTY_START, EMPTY_END
+
+        return bounds[:-1] / self.generate_sample_rate, bounds[1:] / self.generate_sample_rate, flags
 
     @staticmethod
     def combine_segments(waveform_segments):
@@ -2,6 +2,8 @@ import json
 import os
 import random
 import shutil
+import sys
+import time
 
 import torch.utils.data
 from torch import nn
@@ -10,8 +12,14 @@ from torch.utils.data import DataLoader, random_split
 import pytorch_lightning as pl
 
 from annotate_generator import AudioAnnotateGenerator
-from annotate_dataset import AnnotateData, collect_fn
-from annotate_model import Annotater
+from annotate_corpus import CorpusData, pack_corpus
+from annotate_dataset import AnnotateData, AugmentedAnnotateData, BucketBatchSampler, collect_fn
+from annotate_features import AnnotateFeatureStore
+from annotate_model import Annotater, sequence_mask
+from annotate_transforms import WindowFeaturizer
+
+import _paths  # noqa: F401
+from src.Rendition import video_ids as rendition_video_ids
 
 
 class AnnotateDataModule(pl.LightningDataModule):
@@ -20,8 +28,13 @@ class AnnotateDataModule(pl.LightningDataModule):
 
         self.config = config
         self.generate_data = config["generate_data"]
+        self.featurize = config["featurize"]
+        self.augment_online = config["augment"]["online"]
+        self.items_per_epoch = config["augment"]["items_per_epoch"]
+        self.use_corpus = config["corpus"]["use"]
         self.num_workers = config["train"]["num_workers"]
         self.batch_size = config["train"]["batch_size"]
+        self.pin_memory = config["use_gpu"]
         self.num_data = config["dataset"]["num_data"]
 
         self.num_test = int(self.num_data * config["dataset"]["test"])
@@ -31,12 +44,37 @@ class AnnotateDataModule(pl.LightningDataModule):
         self.annotate_train, self.annotate_valid, self.annotate_test = None, None, None
 
     def prepare_data(self):
+        if self.augment_online:
+            return
         if self.generate_data:
             generator = AudioAnnotateGenerator(self.config)
             generator.start_generates()
+        if self.use_corpus:
+            if self._corpus_stale():
+                pack_corpus(self.config)
+            return
+        if self.featurize:
+            AnnotateFeatureStore(self.config).build(AnnotateData(self.config))
+
+    def _corpus_stale(self):
+        index_path = os.path.join(self.config["corpus"]["path"], "index.npz")
+        segments_path = os.path.join(self.config["path"]["output"], "segments.npz")
+        if not os.path.exists(index_path):
+            return True
+        return os.path.exists(segments_path) and os.path.getmtime(segments_path) > os.path.getmtime(index_path)
 
     def setup(self, stage=None):
-        full_data = AnnotateData(self.config)
+        if self.augment_online:
+            self._setup_online()
+            return
+        if self.use_corpus:
+            self.annotate_train, self.annotate_valid, self.annotate_test = (
+                CorpusData(self.config, split) for split in ("train", "valid", "test")
+            )
+            return
+
+        feature_store = AnnotateFeatureStore(self.config) if self.featurize else None
+        full_data = AnnotateData(self.config, feature_store)
         self.annotate_train, self.annotate_valid, self.annotate_test, _ = random_split(
             full_data, [
                 self.num_train, self.num_valid, self.num_test,
@@ -44,23 +82,92 @@ class AnnotateDataModule(pl.LightningDataModule):
             ]
         )
 
-    def train_dataloader(self):
+    # originals are split by video, the same way for every run
+    def _setup_online(self):
+        video_ids = rendition_video_ids(self.config["path"]["youtube_audio"])
+        random.Random(self.config["generate"]["seed"]).shuffle(video_ids)
+
+        num_test = int(len(video_ids) * self.config["dataset"]["test"])
+        num_valid = int(len(video_ids) * self.config["dataset"]["validation"])
+        test_ids, valid_ids = video_ids[:num_test], video_ids[num_test:num_test + num_valid]
+        train_ids = video_ids[num_test + num_valid:]
+
+        num_items = self.items_per_epoch
+        self.annotate_train = AugmentedAnnotateData(self.config, train_ids, num_items - self.num_valid - self.num_test)
+        self.annotate_valid = AugmentedAnnotateData(self.config, valid_ids or train_ids, self.num_valid, "valid")
+        self.annotate_test = AugmentedAnnotateData(self.config, test_ids or train_ids, self.num_test, "test")
+
+    def _batch_sampler(self, dataset, shuffle):
+        if isinstance(dataset, torch.utils.data.Subset):
+            lengths = [dataset.dataset.window_count(index) for index in dataset.indices]
+        else:
+            lengths = [dataset.window_count(index) for index in range(len(dataset))]
+        return BucketBatchSampler(lengths, self.batch_size, shuffle=shuffle)
+
+    def _dataloader(self, dataset, shuffle):
+        if self.augment_online:
+            return DataLoader(
+                dataset, batch_size=self.batch_size,
+                num_workers=self.num_workers, collate_fn=collect_fn, pin_memory=self.pin_memory
+            )
         return DataLoader(
-            self.annotate_train, batch_size=self.batch_size,
-            num_workers=self.num_workers, collate_fn=collect_fn
+            dataset, batch_sampler=self._batch_sampler(dataset, shuffle),
+            num_workers=self.num_workers, collate_fn=collect_fn, pin_memory=self.pin_memory
         )
 
+    def train_dataloader(self):
+        return self._dataloader(self.annotate_train, True)
+
     def val_dataloader(self):
-        return DataLoader(
-            self.annotate_valid, batch_size=self.batch_size,
-            num_workers=self.num_workers, collate_fn=collect_fn
-        )
+        return self._dataloader(self.annotate_valid, False)
 
     def test_dataloader(self):
-        return DataLoader(
-            self.annotate_test, batch_size=self.batch_size,
-            num_workers=self.num_workers, collate_fn=collect_fn
-        )
+        return self._dataloader(self.annotate_test, False)
+
+
+# samples/s, windows/s and peak memory of every training epoch
+class ThroughputReport(pl.Callback):
+    def __init__(self):
+        super().__init__()
+        self.start_time = 0.0
+        self.samples = 0
+        self.windows = 0
+
+    def on_train_epoch_start(self, trainer, pl_module):
+        if pl_module.device.type == "cuda":
+            torch.cuda.reset_peak_memory_stats(pl_module.device)
+        self.start_time = time.perf_counter()
+        self.samples, self.windows = 0, 0
+
+    def on_train_batch_end(self, trainer, pl_module, outputs, batch, batch_idx):
+        self.samples += batch[4]
+        self.windows += int(batch[6].sum())
+
+    def on_train_epoch_end(self, trainer, pl_module):
+        if pl_module.device.type == "cuda":
+            torch.cuda.synchronize(pl_module.device)
+        seconds = max(time.perf_counter() - self.start_time, 1e-9)
+
+        metrics = {"samples_per_sec": self.samples / seconds, "windows_per_sec": self.windows / seconds}
+        peak_memory = self.peak_memory_mb(pl_module.device)
+        if peak_memory is not None:
+            metrics["peak_memory_mb"] = peak_memory
+        pl_module.log_dict(metrics)
+
+        print(f"Epoch {trainer.current_epoch}, " + ", ".join(f"{key}: {value:.2f}" for key, value in metrics.items()))
+
+    # device memory on cuda, peak resident set of the process elsewhere; ru_maxrss is in bytes on
+    # macos and in kilobytes on linux
+    @staticmethod
+    def peak_memory_mb(device):
+        if device.type == "cuda":
+            return torch.cuda.max_memory_allocated(device) / 1024 ** 2
+        try:
+            import resource
+        except ImportError:
+            return None
+        max_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        return max_rss / 1024 ** 2 if sys.platform == "darwin" else max_rss / 1024
 
 
 class AnnotateModule(pl.LightningModule):
@@ -69,6 +176,12 @@ class AnnotateModule(pl.LightningModule):
 
         self.learning_rate = config["train"]["learning_rate"]
         self.annotater = Annotater(config)
+        if config["train_profile"]["channels_last"]:
+            self.annotater.to_channels_last()
+        self.featurizer = WindowFeaturizer(
+            config["generate"]["sample_rate"], config["dataset"]["train_sample_rate"],
+            config["dataset"]["n_feats"], config["dataset"]["n_fft"]
+        )
 
         self.status_loss = nn.MSELoss()
         self.position_loss = nn.L1Loss()
@@ -76,29 +189,54 @@ class AnnotateModule(pl.LightningModule):
     def forward(self, z1, z2, hidden):
         return self.annotater(z1, z2, hidden)
 
+    # the featurizer takes its kernels from the shared registry, checkpoints from before still
+    # carry them as buffers
+    def on_load_checkpoint(self, checkpoint):
+        checkpoint["state_dict"] = {
+            key: value for key, value in checkpoint["state_dict"].items() if not key.startswith("featurizer.")
+        }
+
     def configure_optimizers(self):
         optimizer = torch.optim.Adam(self.parameters(), lr=self.learning_rate)
         return optimizer
 
+    # raw [batch, windows, channels, samples] batches are resampled and featurized here in one go,
+    # only the windows the mask keeps, the padding stays zero. int16 audio from a packed corpus is
+    # scaled back to [-1, 1] first
+    def _features(self, x, mask):
+        if x.dim() == 5:
+            return x
+        x = x[mask]
+        x = x.float() / 32767 if x.dtype == torch.int16 else x.float()
+        # sinc resampling and the mel filterbank lose too much in half precision
+        with torch.autocast(self.device.type, enabled=False):
+            features = self.featurizer(x)
+        padded = features.new_zeros(mask.shape + features.shape[1:])
+        padded[mask] = features
+        return padded
+
     def _step(self, batch):
-        x_originals, x_changes, y_positions, y_states, batch_size, max_len = batch
-        hidden = self.annotater.init_hidden(batch_size)
-        hn, c0 = hidden[0].to(self.device), hidden[1].to(self.device)
-        y_hat_positions = []
-        y_hats_states = []
-        for i in range(max_len):
-            y_hat_pos, y_hat_sta, (hn, c0) = self(x_originals[:, i], x_changes[:, i], (hn, c0))
-            y_hat_positions.append(y_hat_pos)
-            y_hats_states.append(y_hat_sta)
-
-        y_hat_positions = torch.stack(y_hat_positions, dim=1)
-        y_hats_states = torch.stack(y_hats_states, dim=1)
-
-        pos_loss = self.position_loss(y_hat_positions, y_positions)
-        sta_loss = self.status_loss(y_hats_states, y_states)
+        x_originals, x_changes, y_positions, y_states, batch_size, max_len, lengths = batch
+        # padded steps are not featurized and do not count towards the losses
+        mask = sequence_mask(lengths, max_len).to(self.device)
+        x_originals, x_changes = self._features(x_originals, mask), self._features(x_changes, mask)
+        y_hat_positions, y_hats_states, _ = self.annotater.forward_sequence(x_originals, x_changes, lengths=lengths)
+
+        pos_loss = self.position_loss(y_hat_positions[mask], y_positions[mask])
+        sta_loss = self.status_loss(y_hats_states[mask], y_states[mask])
 
         return pos_loss, sta_loss
 
+    # online augmented items are seeded by epoch, workers copy the dataset when the epoch starts.
+    # lightning only sets the epoch of a batch sampler's inner sampler, so the bucket batches
+    # are reshuffled here too, before the epoch's iterator is created
+    def on_train_epoch_start(self):
+        dataloader = self.trainer.train_dataloader
+        if isinstance(dataloader.dataset, AugmentedAnnotateData):
+            dataloader.dataset.set_epoch(self.current_epoch)
+        if isinstance(dataloader.batch_sampler, BucketBatchSampler):
+            dataloader.batch_sampler.set_epoch(self.current_epoch)
+
     def training_step(self, batch):
         pos_loss, sta_loss = self._step(batch)
 
@@ -116,18 +254,25 @@ class AnnotateModule(pl.LightningModule):
 
 
 if __name__ == "__main__":
-    os.environ["CUDA_LAUNCH_BLOCKING"] = "1"
-    torch.set_float32_matmul_precision('medium')
     gpus = min(1, torch.cuda.device_count())
     with open("config.json", "r") as j_file:
         audio_spliter_config = json.load(j_file)
 
+    train_profile = audio_spliter_config["train_profile"]
+    torch.set_float32_matmul_precision(train_profile["matmul_precision"])
+
     data_module = AnnotateDataModule(audio_spliter_config)
     model = AnnotateModule(audio_spliter_config)
 
+    trainer_args = {
+        "max_epochs": audio_spliter_config["train"]["epochs"],
+        "precision": train_profile["precision"],
+        "accumulate_grad_batches": train_profile["accumulate_grad_batches"],
+        "callbacks": [ThroughputReport()]
+    }
     if audio_spliter_config["use_gpu"]:
-        trainer = pl.Trainer(max_epochs=audio_spliter_config["train"]["epochs"], devices=gpus)
+        trainer = pl.Trainer(devices=gpus, **trainer_args)
     else:
-        trainer = pl.Trainer(max_epochs=audio_spliter_config["train"]["epochs"])
+        trainer = pl.Trainer(**trainer_args)
 
     trainer.fit(model, data_module)
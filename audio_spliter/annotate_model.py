@@ -1,7 +1,16 @@
+import math
+
+import numpy as np
 import torch
 from torch import nn
 from torch.nn import functional as fn
 
+from annotate_transforms import frame_waveform, get_mel_spectrogram
+
+
+def sequence_mask(lengths, max_len):
+    return torch.arange(max_len, device=lengths.device).unsqueeze(0) < lengths.unsqueeze(1)
+
 
 class Annotater(nn.Module):
     def __init__(self, config):
@@ -10,12 +19,16 @@ class Annotater(nn.Module):
         self.num_layers = config["train"]["num_layers"]
         self.hidden_size = config["train"]["hidden_size"]
         self.dropout = config["train"]["dropout"]
+        self.bidirectional = config["train"]["bidirectional"]
+        self.num_directions = 2 if self.bidirectional else 1
         self.n_feats = config["dataset"]["n_feats"]
         self.n_fft = config["dataset"]["n_fft"]
 
         self.original_sec = config["generate"]["seconds_per_segment"]
         self.changed_sec = config["dataset"]["seconds_per_item"]
+        self.push_sec = config["dataset"]["push_seconds"]
         self.train_sample_rate = config["dataset"]["train_sample_rate"]
+        self.channels_last = False
 
         self.conv1 = nn.Sequential(
             nn.Dropout(self.dropout),
@@ -44,29 +57,50 @@ class Annotater(nn.Module):
 
         self.dense1 = nn.Sequential(
             nn.Dropout(self.dropout),
-            nn.LazyLinear(int((self.original_sec + self.changed_sec) * 768))
+            nn.Linear(self.encoded_size(), int((self.original_sec + self.changed_sec) * 768))
         )
 
         self.lstm1 = nn.LSTM(
             input_size=int((self.original_sec + self.changed_sec) * 768), hidden_size=self.hidden_size,
             num_layers=self.num_layers, dropout=self.dropout,
-            bidirectional=True
+            bidirectional=self.bidirectional
         )
 
-        self.dense_position = nn.Linear(self.hidden_size * 2, 2)
-        self.dense_status = nn.Linear(self.hidden_size * 2, 1)
+        self.dense_position = nn.Linear(self.hidden_size * self.num_directions, 2)
+        self.dense_status = nn.Linear(self.hidden_size * self.num_directions, 1)
+
+    # MelSpectrogram hops n_fft // 2 samples and pads the window by as much on both ends
+    def mel_frames(self, seconds):
+        return int(seconds * self.train_sample_rate) // (self.n_fft // 2) + 1
+
+    # size of the flattened conv2 output, each conv block halves both mel and frame axes
+    def encoded_size(self):
+        frames = self.mel_frames(self.original_sec) + self.mel_frames(self.changed_sec)
+        return 32 * (self.n_feats // 4) * (frames // 4)
+
+    # nhwc conv weights and inputs, faster conv kernels under mixed precision
+    def to_channels_last(self):
+        self.channels_last = True
+        self.conv1.to(memory_format=torch.channels_last)
+        self.conv2.to(memory_format=torch.channels_last)
+        return self
 
     def init_hidden(self, batch_size):
-        n, hs = self.num_layers, self.hidden_size
-        return torch.zeros(n * 2, batch_size, hs), torch.zeros(n * 2, batch_size, hs)
+        n, hs = self.num_layers * self.num_directions, self.hidden_size
+        return torch.zeros(n, batch_size, hs), torch.zeros(n, batch_size, hs)
 
-    def forward(self, x1, x2, hidden):
+    def encode(self, x1, x2):
         x = torch.cat((x1, x2), dim=3)
         x = torch.mean(x, dim=1, keepdim=True)
+        if self.channels_last:
+            x = x.contiguous(memory_format=torch.channels_last)
         x = self.conv1(x)
         x = self.conv2(x)
-        x = x.view(x.size(0), -1)
-        x = self.dense1(x)
+        x = x.reshape(x.size(0), -1)
+        return self.dense1(x)
+
+    def forward(self, x1, x2, hidden):
+        x = self.encode(x1, x2)
         x = x.unsqueeze(0)
         x, (hn, cn) = self.lstm1(x, hidden)
         x = x.squeeze(0)
@@ -74,3 +108,150 @@ class Annotater(nn.Module):
         x_sta = self.dense_status(x)
 
         return torch.sigmoid(x_pos), torch.sigmoid(x_sta), (hn, cn)
+
+    # x1, x2: [batch, windows, channels, n_feats, frames], every window goes through the conv
+    # front-end as one batch and the whole sequence through the lstm in one call. With lengths,
+    # padded windows are skipped and the lstm runs on a packed sequence
+    def forward_sequence(self, x1, x2, hidden=None, lengths=None):
+        batch_size, max_len = x1.size(0), x1.size(1)
+        if lengths is None:
+            x = self.encode(x1.flatten(0, 1), x2.flatten(0, 1))
+            x = x.view(batch_size, max_len, -1).transpose(0, 1)
+            x, (hn, cn) = self.lstm1(x, hidden)
+            x = x.transpose(0, 1)
+        else:
+            mask = sequence_mask(lengths, max_len).to(x1.device).flatten()
+            features = self.encode(x1.flatten(0, 1)[mask], x2.flatten(0, 1)[mask])
+            x = features.new_zeros(batch_size * max_len, features.size(1))
+            x[mask] = features
+            x = x.view(batch_size, max_len, -1)
+            x = nn.utils.rnn.pack_padded_sequence(x, lengths.cpu(), batch_first=True, enforce_sorted=False)
+            x, (hn, cn) = self.lstm1(x, hidden)
+            x, _ = nn.utils.rnn.pad_packed_sequence(x, batch_first=True, total_length=max_len)
+        x_pos = self.dense_position(x)
+        x_sta = self.dense_status(x)
+
+        return torch.sigmoid(x_pos), torch.sigmoid(x_sta), (hn, cn)
+
+    def _log_mel_spec(self, waveform):
+        mel_spectrogram = get_mel_spectrogram(self.train_sample_rate, self.n_feats, self.n_fft, waveform.device)
+        return torch.log(mel_spectrogram(waveform) + 1e-14)
+
+    # log mel spectrograms of the seconds_per_segment segments of original, the last zero padded
+    def segment_features(self, original):
+        segment_frames = int(self.original_sec * self.train_sample_rate)
+        num_segments = max(1, math.ceil(original.size(-1) / segment_frames))
+        segments = frame_waveform(original, segment_frames, segment_frames, torch.arange(num_segments))
+        return self._log_mel_spec(segments)
+
+    # original, cover: [channels, samples] at train_sample_rate. Windows are paired with original
+    # segments by progression, as in training; returns start and end seconds, in the cover, of
+    # the segments the model completes
+    @torch.no_grad()
+    def annotate(self, original, cover, threshold=0.5, max_passes=8):
+        was_training = self.training
+        self.eval()
+
+        device = next(self.parameters()).device
+        original, cover = original.to(device), cover.to(device)
+
+        item_frames = int(self.changed_sec * self.train_sample_rate)
+        push_frames = int(self.push_sec * self.train_sample_rate)
+
+        num_windows = max(1, math.ceil((cover.size(-1) - item_frames) / push_frames) + 1)
+        window_ids = torch.arange(num_windows)
+        cover_windows = frame_waveform(cover, item_frames, push_frames, window_ids)
+        x1 = self.segment_features(original)
+
+        if self.bidirectional:
+            x2 = self._log_mel_spec(cover_windows)
+
+            def run(step_windows, step_segments):
+                y_position, y_state, _ = self.forward_sequence(
+                    x1[step_segments.to(device)].unsqueeze(0), x2[step_windows.to(device)].unsqueeze(0)
+                )
+                return y_position[0], y_state[0]
+
+            step_windows, y_position, y_state = refine_pairs(run, num_windows, len(x1), threshold, max_passes)
+            starts, ends = step_boundaries(y_position, y_state, step_windows, self.push_sec, self.changed_sec, threshold)
+        else:
+            starts, ends, _, _ = self.annotate_windows(x1, cover_windows, window_ids, threshold=threshold)
+
+        self.train(was_training)
+        return starts, ends
+
+    # causal decoding of cover_windows: [windows, channels, samples], the cover windows starting at
+    # window_ids * push_sec, against x1, the segment_features of the original. Steps one window at
+    # a time from hidden and original segment `segment`, a window that completes its segment is
+    # stepped again with the next one. Also returns the lstm state and the segment to carry over
+    # to the next windows, segment is len(x1) once every segment is complete
+    def annotate_windows(self, x1, cover_windows, window_ids, hidden=None, segment=0, threshold=0.5):
+        x2 = self._log_mel_spec(cover_windows)
+        step_windows, y_positions, y_states = [], [], []
+        for i in range(len(x2)):
+            while segment < len(x1):
+                y_position, y_state, hidden = self.forward_sequence(x1[segment][None, None], x2[i][None, None], hidden)
+                step_windows.append(int(window_ids[i]))
+                y_positions.append(y_position[0])
+                y_states.append(y_state[0])
+                if not completed_steps(y_position[0], y_state[0], threshold)[0]:
+                    break
+                segment += 1
+
+        if not step_windows:
+            return np.zeros(0, dtype=np.float32), np.zeros(0, dtype=np.float32), hidden, segment
+        starts, ends = step_boundaries(
+            torch.cat(y_positions), torch.cat(y_states), torch.tensor(step_windows),
+            self.push_sec, self.changed_sec, threshold
+        )
+        return starts, ends, hidden, segment
+
+
+# the (window, original segment) steps of a cover as AnnotateData.window_targets pairs them in
+# training: original segment 0 through the empty start, and a window that completes its segment
+# is paired again with the next one. completed[i] tells whether step i completed its segment,
+# steps past the end of completed are taken as not completing
+def progression_pairs(num_windows, num_segments, completed=()):
+    step_windows, step_segments = [], []
+    window, segment = 0, 0
+    while window < num_windows and segment < num_segments:
+        step_windows.append(window)
+        step_segments.append(segment)
+        if len(step_windows) <= len(completed) and completed[len(step_windows) - 1]:
+            segment += 1
+        else:
+            window += 1
+    return torch.tensor(step_windows, dtype=torch.long), torch.tensor(step_segments, dtype=torch.long)
+
+
+# a step completes its segment when the segment ends inside the window: training gives full
+# windows a state of 1 and an end position of at least 1 - push / item past the first window,
+# other windows an end position of 0
+def completed_steps(y_position, y_state, threshold=0.5):
+    return (y_position[..., 1] > threshold) & (y_state[..., 0] > threshold)
+
+
+# a model that sees the whole sequence at once cannot be stepped, so its pairing is rebuilt from
+# the completions of the previous pass until it no longer changes, at most max_passes times.
+# run(step_windows, step_segments) returns y_position, y_state of every step
+def refine_pairs(run, num_windows, num_segments, threshold=0.5, max_passes=8):
+    step_windows, step_segments = progression_pairs(num_windows, num_segments)
+    for _ in range(max_passes):
+        y_position, y_state = run(step_windows, step_segments)
+        completed = completed_steps(y_position, y_state, threshold).tolist()
+        next_windows, next_segments = progression_pairs(num_windows, num_segments, completed)
+        if torch.equal(next_windows, step_windows) and torch.equal(next_segments, step_segments):
+            break
+        step_windows, step_segments = next_windows, next_segments
+    else:
+        y_position, y_state = run(step_windows, step_segments)
+    return step_windows, y_position, y_state
+
+
+# start and end seconds, in the cover, of the segments completed by the steps
+def step_boundaries(y_position, y_state, step_windows, push_sec, item_sec, threshold=0.5):
+    window_secs = step_windows.to(y_state.device) * push_sec
+    keep = completed_steps(y_position, y_state, threshold)
+    starts = window_secs + y_position[:, 0] * item_sec
+    ends = window_secs + y_position[:, 1] * item_sec
+    return starts[keep].cpu().numpy(), ends[keep].cpu().numpy()
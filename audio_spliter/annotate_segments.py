@@ -0,0 +1,141 @@
+import json
+import os
+import time
+
+import numpy as np
+
+import _paths  # noqa: F401
+from src.Segments import EMPTY_END, EMPTY_START, save_segments
+
+
+# legacy {"seconds_per_segment", "segments": {"0": {"start", "end", "#"}, ...}} config as columns,
+# the first and last segments are the empty padding around the changed audio
+def segments_from_config(wav_config):
+    segments = [wav_config["segments"][key] for key in sorted(wav_config["segments"], key=int)]
+    starts = np.array([segment["start"] for segment in segments], dtype=np.float64)
+    ends = np.array([segment["end"] for segment in segments], dtype=np.float64)
+
+    flags = np.zeros(len(segments), dtype=np.uint8)
+    flags[0] |= EMPTY_START
+    flags[-1] |= EMPTY_END
+
+    return float(wav_config["seconds_per_segment"]), starts, ends, flags
+
+
+# a segment file, .npz or legacy .json
+def load_segments(path):
+    if path.endswith(".json"):
+        with open(path, "r", encoding="utf-8") as file:
+            return segments_from_config(json.load(file))
+
+    with np.load(path) as data:
+        return float(data["seconds_per_segment"]), data["starts"], data["ends"], data["flags"]
+
+
+def segment_files(config_path):
+    names = {}
+    for path in sorted(os.listdir(config_path)) if os.path.isdir(config_path) else []:
+        name, extension = os.path.splitext(path)
+        if extension == ".npz" or (extension == ".json" and name not in names):
+            names[name] = path
+    return names
+
+
+# the segments of every generated file in one .npz: concatenated columns and per file offsets,
+# so the dataset reads a single file instead of one per generated audio
+class SegmentIndex:
+    def __init__(self, names, seconds_per_segment, offsets, starts, ends, flags):
+        self.names = list(names)
+        self.rows = {name: i for i, name in enumerate(self.names)}
+        self.seconds_per_segment = seconds_per_segment
+        self.offsets = offsets
+        self.starts = starts
+        self.ends = ends
+        self.flags = flags
+
+    def __len__(self):
+        return len(self.names)
+
+    def __contains__(self, name):
+        return name in self.rows
+
+    def __getitem__(self, name):
+        row = self.rows[name]
+        lo, hi = self.offsets[row], self.offsets[row + 1]
+        return float(self.seconds_per_segment[row]), self.starts[lo:hi], self.ends[lo:hi], self.flags[lo:hi]
+
+    def segment_counts(self):
+        return np.diff(self.offsets)
+
+    @classmethod
+    def from_directory(cls, config_path):
+        files = segment_files(config_path)
+        names = list(files)
+        columns = [load_segments(os.path.join(config_path, files[name])) for name in names]
+
+        counts = [len(starts) for _, starts, _, _ in columns]
+        return cls(
+            names,
+            np.array([seconds for seconds, _, _, _ in columns], dtype=np.float64),
+            np.concatenate(([0], np.cumsum(counts))).astype(np.int64),
+            np.concatenate([starts for _, starts, _, _ in columns]) if columns else np.zeros(0),
+            np.concatenate([ends for _, _, ends, _ in columns]) if columns else np.zeros(0),
+            np.concatenate([flags for _, _, _, flags in columns]) if columns else np.zeros(0, dtype=np.uint8)
+        )
+
+    def save(self, path):
+        tmp_path = path + ".tmp"
+        with open(tmp_path, "wb") as file:
+            np.savez(
+                file, names=np.array(self.names, dtype=str), seconds_per_segment=self.seconds_per_segment,
+                offsets=self.offsets, starts=self.starts, ends=self.ends, flags=self.flags
+            )
+        os.replace(tmp_path, path)
+
+    @classmethod
+    def load(cls, path):
+        with np.load(path) as data:
+            return cls(
+                data["names"].tolist(), data["seconds_per_segment"], data["offsets"],
+                data["starts"], data["ends"], data["flags"]
+            )
+
+    # adding or replacing a segment file bumps the directory mtime, which makes the index stale
+    @classmethod
+    def load_or_build(cls, config_path, index_path):
+        if os.path.exists(index_path) and (
+                not os.path.isdir(config_path) or os.path.getmtime(index_path) >= os.path.getmtime(config_path)
+        ):
+            return cls.load(index_path)
+
+        index = cls.from_directory(config_path)
+        if os.path.isdir(config_path):
+            index.save(index_path)
+        return index
+
+
+# rewrite the legacy json segment configs of a directory as .npz
+def convert_legacy(config_path):
+    converted = 0
+    for name, path in segment_files(config_path).items():
+        if not path.endswith(".json"):
+            continue
+        save_segments(os.path.join(config_path, name + ".npz"), *load_segments(os.path.join(config_path, path)))
+        os.remove(os.path.join(config_path, path))
+        converted += 1
+    return converted
+
+
+if __name__ == "__main__":
+    with open("config.json", "r") as j_file:
+        audio_spliter_config = json.load(j_file)
+
+    output_path = audio_spliter_config["path"]["output"]
+    segment_config_path = os.path.join(output_path, "config")
+
+    start_time = time.time()
+    num_converted = convert_legacy(segment_config_path)
+    segment_index = SegmentIndex.from_directory(segment_config_path)
+    segment_index.save(os.path.join(output_path, "segments.npz"))
+    print(f"Converted {num_converted} json configs, indexed {len(segment_index)} files, "
+          f"{time.time() - start_time:.2f} secs")
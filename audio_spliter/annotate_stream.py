@@ -0,0 +1,103 @@
+import math
+
+import numpy as np
+import torch
+
+from annotate_transforms import frame_waveform
+
+import _paths  # noqa: F401
+from src.AudioReader import AudioReader, ChunkedResampler
+
+
+# online annotation of a cover against its original with a causal Annotater: cover chunks are
+# pushed as they arrive (download, playback buffer), every window is annotated as soon as its
+# seconds_per_item of audio are there and the lstm state and original segment reached are
+# carried over to the next push.
+# original is at the train sample rate, cover chunks at sample_rate; push and flush return the
+# start and end seconds, in the cover, found in the new windows
+class AnnotationStream:
+    def __init__(self, annotater, original, sample_rate, threshold=0.5):
+        if annotater.bidirectional:
+            raise ValueError("AnnotationStream needs a causal Annotater, train it with train.bidirectional false")
+
+        self.annotater = annotater
+        self.threshold = threshold
+        self.sample_rate = sample_rate
+        self.device = next(annotater.parameters()).device
+
+        train_sample_rate = annotater.train_sample_rate
+        self.resampler = None
+        if sample_rate != train_sample_rate:
+            self.resampler = ChunkedResampler(sample_rate, train_sample_rate, original.dtype)
+        self.x1 = annotater.segment_features(original.to(self.device))
+
+        self.item_frames = int(annotater.changed_sec * train_sample_rate)
+        self.push_frames = int(annotater.push_sec * train_sample_rate)
+
+        # cover samples from the start of window next_window on
+        self.buffer = None
+        self.next_window = 0
+        self.hidden = None
+        self.segment = 0
+
+    # seconds of cover audio between a window's first sample arriving and it being annotated
+    @property
+    def latency_seconds(self):
+        context = self.resampler.context / self.sample_rate if self.resampler is not None else 0
+        return self.annotater.changed_sec + context
+
+    def _append(self, waveform):
+        waveform = waveform.to(self.device)
+        self.buffer = waveform if self.buffer is None else torch.cat((self.buffer, waveform), dim=-1)
+
+    def push(self, chunk):
+        if self.resampler is not None:
+            chunk = self.resampler.process(chunk)
+        self._append(chunk)
+
+        available = self.buffer.size(-1) - self.item_frames
+        return self._annotate(available // self.push_frames + 1 if available >= 0 else 0)
+
+    # annotate the windows left at the end of the cover, zero padded like Annotater.annotate
+    def flush(self):
+        if self.resampler is not None:
+            tail = self.resampler.flush()
+            if tail is not None:
+                self._append(tail)
+        if self.buffer is None:
+            return np.zeros(0, dtype=np.float32), np.zeros(0, dtype=np.float32)
+
+        cover_frames = self.next_window * self.push_frames + self.buffer.size(-1)
+        num_windows = max(1, math.ceil((cover_frames - self.item_frames) / self.push_frames) + 1)
+        return self._annotate(num_windows - self.next_window)
+
+    def feed(self, chunks):
+        for chunk in chunks:
+            yield self.push(chunk)
+        yield self.flush()
+
+    @torch.no_grad()
+    def _annotate(self, num_windows):
+        if num_windows <= 0:
+            return np.zeros(0, dtype=np.float32), np.zeros(0, dtype=np.float32)
+
+        was_training = self.annotater.training
+        self.annotater.eval()
+
+        cover_windows = frame_waveform(self.buffer, self.item_frames, self.push_frames, torch.arange(num_windows))
+        window_ids = torch.arange(self.next_window, self.next_window + num_windows)
+        starts, ends, self.hidden, self.segment = self.annotater.annotate_windows(
+            self.x1, cover_windows, window_ids, self.hidden, self.segment, self.threshold
+        )
+
+        self.annotater.train(was_training)
+
+        self.buffer = self.buffer[:, num_windows * self.push_frames:]
+        self.next_window += num_windows
+        return starts, ends
+
+
+def annotate_file_stream(annotater, original, cover_path, chunk_frames=2 ** 16, threshold=0.5):
+    reader = AudioReader(cover_path, chunk_frames)
+    stream = AnnotationStream(annotater, original, reader.sample_rate, threshold)
+    yield from stream.feed(reader)
@@ -0,0 +1,61 @@
+import math
+from functools import lru_cache
+
+import torch
+from torch import nn
+import torch.nn.functional as fn
+
+import _paths  # noqa: F401
+from src.Transforms import get_mel_spectrogram, get_resample
+
+
+@lru_cache(maxsize=8)
+def get_window_featurizer(sample_rate, train_sample_rate, n_mels, n_fft, device="cpu"):
+    return WindowFeaturizer(sample_rate, train_sample_rate, n_mels, n_fft)
+
+
+# frames of `size` samples every `step` samples, zero padded past the end, selected by frame_ids
+def frame_waveform(waveform, size, step, frame_ids):
+    num_frames = int(frame_ids.max()) + 1 if len(frame_ids) else 0
+    needed = max((num_frames - 1) * step + size, size)
+    if waveform.size(-1) < needed:
+        waveform = fn.pad(waveform, (0, needed - waveform.size(-1)))
+    frames = waveform.unfold(-1, size, step).transpose(0, 1)
+    return frames[frame_ids.to(frames.device)]
+
+
+# log-mel features of raw waveform windows at sample_rate, resampled to train_sample_rate on
+# whatever device the windows are on, with the Resample and MelSpectrogram of that device from the
+# shared registry. Windows carry `margin` extra samples on both sides so resampling them one by
+# one gives the same samples as resampling the whole signal, except past its end where the
+# filter tail is kept instead of zero padding
+class WindowFeaturizer(nn.Module):
+    def __init__(self, sample_rate, train_sample_rate, n_mels, n_fft):
+        super().__init__()
+        self.sample_rate = sample_rate
+        self.train_sample_rate = train_sample_rate
+        self.n_mels = n_mels
+        self.n_fft = n_fft
+
+        gcd = math.gcd(sample_rate, train_sample_rate)
+        self.orig, self.new = sample_rate // gcd, train_sample_rate // gcd
+        if sample_rate != train_sample_rate:
+            width = get_resample(sample_rate, train_sample_rate).width
+            self.margin = math.ceil((width + self.orig) / self.orig) * self.orig
+        else:
+            self.margin = 0
+
+    # windows of `seconds` every `push_seconds` selected by frame_ids, margins included: [n, channels, samples]
+    def frame(self, waveform, seconds, push_seconds, frame_ids):
+        size, step = int(seconds * self.sample_rate), int(push_seconds * self.sample_rate)
+        return frame_waveform(fn.pad(waveform, (self.margin, 0)), size + 2 * self.margin, step, frame_ids)
+
+    # [..., samples + 2 * margin] -> [..., n_mels, frames]
+    def forward(self, windows):
+        frames = (windows.size(-1) - 2 * self.margin) * self.new // self.orig
+        start = self.margin * self.new // self.orig
+        if self.sample_rate != self.train_sample_rate:
+            windows = get_resample(self.sample_rate, self.train_sample_rate, windows.dtype, windows.device)(windows)
+        waveform = windows[..., start:start + frames]
+        mel_spectrogram = get_mel_spectrogram(self.train_sample_rate, self.n_mels, self.n_fft, windows.device)
+        return torch.log(mel_spectrogram(waveform) + 1e-14)
@@ -9,7 +9,7 @@ from matplotlib.figure import Figure
 from torch.distributed.elastic.agent.server import Worker
 
 from gui.qt_widgets import ExtendedComboBox, PlotCanvas
-from src import YouTubeVideo, AudioPlayer
+from src import YouTubeVideo, AudioPlayer, SourceAudioCache, MediaCache, MetadataStore
 
 
 class MainGUI(QtWidgets.QMainWindow):
@@ -31,6 +31,9 @@ class MainGUI(QtWidgets.QMainWindow):
         self.current_index = 0
 
         self.audio_player = None
+        self.source_cache = SourceAudioCache(self.config.source_cache_path)
+        self.media_cache = MediaCache(self.config.audio_path, self.config.media_cache_max_bytes)
+        self.metadata_store = MetadataStore(self.config.metadata_store_path, self.config.metadata_ttl_seconds)
 
         combo_box1 = self.ui.findChild(QComboBox, "instrument_cbx")
         self.instrument_cbx = ExtendedComboBox(self)
@@ -80,8 +83,8 @@ class MainGUI(QtWidgets.QMainWindow):
     def _get_audios(self, original_url, cover_url):
         self.get_audios_btn.setEnabled(False)
         try:
-            original_video = YouTubeVideo.get_video_from_url(original_url)
-            cover_video = YouTubeVideo.get_video_from_url(cover_url)
+            original_video = YouTubeVideo.get_video_from_url(original_url, self.metadata_store)
+            cover_video = YouTubeVideo.get_video_from_url(cover_url, self.metadata_store)
         except ValueError:
             msg_box = QMessageBox()
             msg_box.setWindowTitle("Invalid Input")
@@ -92,8 +95,14 @@ class MainGUI(QtWidgets.QMainWindow):
             self.get_audios_btn.setEnabled(True)
             return
 
-        original_wav_path, original_config_path = original_video.getMP3(self.config.audio_path, self.config.download_overwrite)
-        cover_wav_path, cover_config_path = cover_video.getMP3(self.config.audio_path, self.config.download_overwrite)
+        original_wav_path, original_config_path = original_video.getMP3(
+            self.config.audio_path, self.config.download_overwrite, self.media_cache, self.config.renditions,
+            self.config.playback_sample_rate
+        )
+        cover_wav_path, cover_config_path = cover_video.getMP3(
+            self.config.audio_path, self.config.download_overwrite, self.media_cache, self.config.renditions,
+            self.config.playback_sample_rate
+        )
 
         self.original_edt.setText("")
         self.original_txt.setText(original_video.title)
@@ -102,7 +111,11 @@ class MainGUI(QtWidgets.QMainWindow):
 
         self.get_audios_btn.setText("Loading audios...")
 
-        self.audio_player = AudioPlayer(original_wav_path, cover_wav_path)
+        if self.audio_player is not None:
+            self.audio_player.close()
+        self.audio_player = AudioPlayer(
+            original_wav_path, cover_wav_path, self.config.playback_sample_rate, cache=self.source_cache
+        )
 
         self.get_audios_btn.setText("Get audios")
         self.get_audios_btn.setEnabled(True)
@@ -38,31 +38,17 @@
 #     for m_track in m_track_generator:
 #         print(m_track.track_id)
 
-import torch
-import torchaudio
-import scipy.signal as signal
-
-original_song, original_sr = torchaudio.load(r"D:\music_to_instrument\data\audios\data\w-tYngyVXLM.wav")
-cover_song, cover_sr = torchaudio.load(r"D:\music_to_instrument\data\audios\data\-pHfPJGatgE.wav")
-
-_, _, spectrogram_original = signal.spectrogram(original_song, original_sr)
-_, _, spectrogram_cover = signal.spectrogram(cover_song, cover_sr)
-
-similarity = signal.correlate(spectrogram_original, spectrogram_cover, mode='same')
-match_indices = torch.argmax(torch.tensor(similarity), dim=1)
-
-segments = []
-prev_index = match_indices[0]
-
-for i in range(1, len(match_indices)):
-    curr_index = match_indices[i]
-    if not torch.eq(prev_index, curr_index):
-        segments.append((prev_index, i))
-        prev_index = curr_index
-
-# Print the matched segments
-for segment in segments:
-    start_time = segment[0]   # Assuming you have the hop length
-    end_time = segment[1]
-    print("Matched segment: Start time:", start_time, "End time:", end_time)
-
+from src.Aligner import Aligner
+
+aligner = Aligner()
+segments = aligner.align_files(
+    r"D:\music_to_instrument\data\audios\data\w-tYngyVXLM.wav",
+    r"D:\music_to_instrument\data\audios\data\-pHfPJGatgE.wav"
+)
+
+# Print the matched segments, unmatched ones are silence or parts the original does not have
+for i in range(len(segments["cover_start"])):
+    if not segments["matched"][i]:
+        continue
+    print("Matched segment: Original:", segments["original_start"][i], "-", segments["original_end"][i],
+          "Cover:", segments["cover_start"][i], "-", segments["cover_end"][i], "Score:", segments["score"][i])
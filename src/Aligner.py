@@ -0,0 +1,198 @@
+import numpy as np
+import torch
+from torchaudio.transforms import MelSpectrogram
+
+from .AudioReader import load_resampled
+from .Segments import EMPTY_END, EMPTY_START
+
+
+# align a cover against its original by cross-correlating low frame rate log-mel features block
+# by block, only searching offsets within max_offset_seconds of the block's own position. Blocks
+# scoring below min_score (silence, noise, parts the original does not have) are unmatched
+class Aligner:
+    def __init__(self, sample_rate=8000, frame_rate=20, n_mels=32, block_seconds=4.0, max_offset_seconds=30.0,
+                 min_score=0.5):
+        self.sample_rate = sample_rate
+        self.frame_rate = frame_rate
+        self.min_score = min_score
+        self.block_frames = max(1, int(round(block_seconds * frame_rate)))
+        self.max_offset_frames = int(round(max_offset_seconds * frame_rate))
+
+        hop_length = sample_rate // frame_rate
+        self.mel_spectrogram = MelSpectrogram(
+            sample_rate=sample_rate, n_fft=hop_length * 4, hop_length=hop_length, n_mels=n_mels
+        )
+
+    def features(self, waveform):
+        waveform = torch.as_tensor(waveform, dtype=torch.float32)
+        if waveform.ndim > 1:
+            waveform = torch.mean(waveform, dim=0)
+
+        with torch.no_grad():
+            features = torch.log(self.mel_spectrogram(waveform) + 1e-6).numpy().astype(np.float64)
+
+        features -= features.mean(axis=1, keepdims=True)
+        features /= np.linalg.norm(features, axis=0, keepdims=True) + 1e-9
+        return features
+
+    @staticmethod
+    def correlate(query, reference, min_lag, max_lag):
+        # scores[k] is the similarity of query placed at reference frame min_lag + k
+        num_lags = max_lag - min_lag + 1
+        length = query.shape[1]
+
+        region = np.zeros((reference.shape[0], length + num_lags - 1))
+        src_start, src_end = max(min_lag, 0), min(max_lag + length, reference.shape[1])
+        if src_end > src_start:
+            region[:, src_start - min_lag:src_end - min_lag] = reference[:, src_start:src_end]
+
+        size = 1 << int(np.ceil(np.log2(region.shape[1] + length)))
+        spectrum = (np.conj(np.fft.rfft(query, size, axis=1)) * np.fft.rfft(region, size, axis=1)).sum(axis=0)
+        return np.fft.irfft(spectrum, size)[:num_lags]
+
+    def align_features(self, original, cover):
+        num_frames = cover.shape[1]
+
+        starts = np.arange(0, num_frames, self.block_frames)
+        offsets = np.zeros(len(starts), dtype=np.int64)
+        block_scores = np.zeros(len(starts))
+        for i, start in enumerate(starts):
+            block = cover[:, start:start + self.block_frames]
+            min_lag = start - self.max_offset_frames
+            scores = self.correlate(block, original, min_lag, start + self.max_offset_frames)
+
+            offsets[i] = int(np.argmax(scores)) + min_lag - start
+            block_scores[i] = scores.max() / block.shape[1]
+
+        ends = np.minimum(starts + self.block_frames, num_frames)
+        matched = block_scores >= self.min_score
+
+        # merge consecutive matched blocks sharing an offset into one segment, and consecutive
+        # unmatched blocks into one whatever their offsets
+        keys = np.where(matched, offsets, np.iinfo(np.int64).min)
+        breaks = np.flatnonzero(np.diff(keys)) + 1
+        first = np.concatenate(([0], breaks))
+        last = np.concatenate((breaks, [len(starts)])) - 1
+        cover_start, cover_end = starts[first], ends[last]
+        weights = ends - starts
+
+        # the best lag can hang a block over either end of the original
+        original_start = np.clip(cover_start + offsets[first], 0, original.shape[1])
+        original_end = np.clip(cover_end + offsets[first], 0, original.shape[1])
+
+        return {
+            "original_start": original_start / self.frame_rate,
+            "original_end": original_end / self.frame_rate,
+            "cover_start": cover_start / self.frame_rate,
+            "cover_end": cover_end / self.frame_rate,
+            "score": np.add.reduceat(block_scores * weights, first) / np.add.reduceat(weights, first),
+            "matched": matched[first]
+        }
+
+    def align(self, original, cover):
+        return self.align_features(self.features(original), self.features(cover))
+
+    def align_files(self, original_path, cover_path):
+        return self.align(
+            load_resampled(original_path, self.sample_rate, num_channels=1),
+            load_resampled(cover_path, self.sample_rate, num_channels=1)
+        )
+
+
+# full warping path between original and cover with multiscale banded dtw: the path found on
+# downsampled features is refined level by level inside a band of +-radius frames around it.
+# Steps are (1, 1), (1, 2) and (2, 1), which limits tempo changes to 0.5x-2x and lets every row
+# be computed from the two rows before it; the original is matched as a whole to a part of the
+# cover, so intros and outros on the cover side are skipped
+class DTWAligner(Aligner):
+    def __init__(self, sample_rate=8000, frame_rate=50, n_mels=32, radius=8, max_dense_frames=512):
+        super().__init__(sample_rate, frame_rate, n_mels)
+        self.radius = radius
+        self.max_dense_frames = max_dense_frames
+
+    @staticmethod
+    def downsample(features):
+        frames = features.shape[1] // 2 * 2
+        coarse = features[:, :frames].reshape(features.shape[0], -1, 2).mean(axis=2)
+        if frames < features.shape[1]:
+            coarse = np.concatenate((coarse, features[:, frames:]), axis=1)
+        return coarse / (np.linalg.norm(coarse, axis=0, keepdims=True) + 1e-9)
+
+    @staticmethod
+    def banded_dtw(original, cover, lo, width):
+        # row i of the band holds cover frames lo[i] .. lo[i] + width - 1
+        num_rows = original.shape[1]
+        columns = np.arange(width)
+        steps = np.zeros((num_rows, width), dtype=np.int8)
+
+        # every original frame is counted once, so the (2, 1) step also pays for the row it skips
+        prev2 = np.full(width, np.inf)
+        prev_cost = 1.0 - original[:, 0] @ cover[:, lo[0] + columns]
+        prev1 = prev_cost
+
+        def shifted(row, row_lo, i, dj):
+            index = lo[i] + columns - dj - row_lo
+            valid = (index >= 0) & (index < width)
+            return np.where(valid, row[np.clip(index, 0, width - 1)], np.inf)
+
+        for i in range(1, num_rows):
+            candidates = np.stack((
+                shifted(prev1, lo[i - 1], i, 1),
+                shifted(prev1, lo[i - 1], i, 2),
+                shifted(prev2, lo[i - 2], i, 1) + shifted(prev_cost, lo[i - 1], i, 0) if i > 1
+                else np.full(width, np.inf)
+            ))
+            steps[i] = np.argmin(candidates, axis=0)
+            cost = 1.0 - original[:, i] @ cover[:, lo[i] + columns]
+            prev2, prev1, prev_cost = prev1, candidates[steps[i], columns] + cost, cost
+
+        if not np.isfinite(prev1).any():
+            raise ValueError("no warping path within the 0.5x-2x tempo range")
+
+        i, k = num_rows - 1, int(np.argmin(prev1))
+        path = [(i, lo[i] + k)]
+        while i > 0:
+            di, dj = ((1, 1), (1, 2), (2, 1))[steps[i, k]]
+            j = lo[i] + k - dj
+            i -= di
+            k = j - lo[i]
+            path.append((i, j))
+
+        return np.array(path[::-1], dtype=np.int64)
+
+    def warp(self, original, cover):
+        num_cols = cover.shape[1]
+        if original.shape[1] <= self.max_dense_frames or num_cols <= self.max_dense_frames:
+            lo = np.zeros(original.shape[1], dtype=np.int64)
+            return self.banded_dtw(original, cover, lo, num_cols)
+
+        coarse_path = self.warp(self.downsample(original), self.downsample(cover))
+
+        width = min(2 * self.radius + 1, num_cols)
+        rows = np.arange(original.shape[1])
+        centers = np.interp(rows / 2, coarse_path[:, 0], coarse_path[:, 1]) * 2
+        lo = np.clip(np.round(centers).astype(np.int64) - self.radius, 0, num_cols - width)
+        return self.banded_dtw(original, cover, lo, width)
+
+    def align_features(self, original, cover):
+        path = self.warp(original, cover)
+        return {
+            "original": path[:, 0] / self.frame_rate,
+            "cover": path[:, 1] / self.frame_rate
+        }
+
+    # the warping path as the columns of a segment file, like AudioAnnotateGenerator writes: the
+    # empty start, a segment per seconds_per_segment of the original and the empty end. Returns
+    # starts, ends and flags for save_segments(path, seconds_per_segment, starts, ends, flags)
+    @staticmethod
+    def path_to_segments(path, seconds_per_segment, original_seconds, cover_seconds):
+        bounds = np.arange(0, original_seconds, seconds_per_segment)
+        bounds = np.append(bounds, original_seconds)
+        cover_bounds = np.interp(bounds, path["original"], path["cover"])
+
+        starts = np.concatenate(([0.0], cover_bounds))
+        ends = np.concatenate((cover_bounds, [cover_seconds]))
+        flags = np.zeros(len(starts), dtype=np.uint8)
+        flags[0], flags[-1] = EMPTY_START, EMPTY_END
+
+        return starts, ends, flags
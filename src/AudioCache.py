@@ -0,0 +1,128 @@
+import hashlib
+import json
+import os
+import shutil
+import threading
+
+import numpy as np
+import torch
+
+from .AudioReader import stream_audio
+
+
+# decoded, trimmed and resampled source audio stored as float32 .npy files, keyed on
+# the file content and the decode settings, shared by every tool that loads songs
+class SourceAudioCache:
+    def __init__(self, cache_path, max_bytes=20 * 1024 ** 3, chunk_frames=2 ** 20):
+        self.cache_path = cache_path
+        self.max_bytes = max_bytes
+        self.chunk_frames = chunk_frames
+        self.hashes_path = os.path.join(cache_path, "hashes")
+
+        if not os.path.isdir(self.hashes_path):
+            os.makedirs(self.hashes_path, exist_ok=True)
+
+    # every source file has its own hash sidecar, written atomically, so workers hashing different
+    # files never overwrite each other's entries
+    def content_hash(self, audio_path):
+        stat = os.stat(audio_path)
+        file_key = os.path.abspath(audio_path)
+        sidecar_path = os.path.join(
+            self.hashes_path, hashlib.sha1(file_key.encode("utf-8")).hexdigest() + ".json"
+        )
+
+        known = self._load_json(sidecar_path)
+        if known is not None and known["size"] == stat.st_size and known["mtime"] == stat.st_mtime:
+            return known["sha1"]
+
+        sha1 = hashlib.sha1()
+        with open(audio_path, "rb") as file:
+            for block in iter(lambda: file.read(1024 * 1024), b""):
+                sha1.update(block)
+
+        self._write_json(sidecar_path, {
+            "path": file_key, "size": stat.st_size, "mtime": stat.st_mtime, "sha1": sha1.hexdigest()
+        })
+        return sha1.hexdigest()
+
+    @staticmethod
+    def _load_json(path):
+        try:
+            with open(path, "r", encoding="utf-8") as file:
+                return json.load(file)
+        except (OSError, ValueError):
+            return None
+
+    @staticmethod
+    def _write_json(path, value):
+        tmp_path = f"{path}.{os.getpid()}.{threading.get_ident()}.tmp"
+        with open(tmp_path, "w", encoding="utf-8") as file:
+            json.dump(value, file)
+        os.replace(tmp_path, path)
+
+    def cache_key(self, audio_path, sample_rate, num_channels=None, trim=None):
+        settings = json.dumps({
+            "content": self.content_hash(audio_path),
+            "sample_rate": sample_rate,
+            "num_channels": num_channels,
+            "trim": trim
+        }, sort_keys=True)
+        return hashlib.sha1(settings.encode("utf-8")).hexdigest()
+
+    # trim: None/False keeps silence, True trims with default settings, a dict passes trim settings
+    def load(self, audio_path, sample_rate, num_channels=None, trim=None, device="cpu"):
+        path = os.path.join(self.cache_path, self.cache_key(audio_path, sample_rate, num_channels, trim) + ".npy")
+
+        if os.path.exists(path):
+            os.utime(path)
+        else:
+            self.decode(audio_path, path, sample_rate, num_channels, trim)
+            self.evict(keep=path)
+
+        return torch.from_numpy(np.load(path, mmap_mode="c")).to(device)
+
+    def decode(self, audio_path, path, sample_rate, num_channels=None, trim=None):
+        raw_path = f"{path}.{os.getpid()}.raw"
+        num_frames, channels = 0, num_channels or 1
+
+        # chunks are written time-major, which is a fortran ordered [channels, frames] array
+        with open(raw_path, "wb") as raw:
+            for chunk in stream_audio(audio_path, sample_rate, num_channels, trim, self.chunk_frames):
+                raw.write(chunk.to(torch.float32).T.contiguous().numpy().tobytes())
+                num_frames += chunk.shape[-1]
+                channels = chunk.shape[0]
+
+        tmp_path = f"{path}.{os.getpid()}.tmp"
+        with open(tmp_path, "wb") as file, open(raw_path, "rb") as raw:
+            np.lib.format.write_array_header_1_0(file, {
+                "descr": np.lib.format.dtype_to_descr(np.dtype(np.float32)),
+                "fortran_order": True,
+                "shape": (channels, num_frames)
+            })
+            shutil.copyfileobj(raw, file, 1024 * 1024)
+        os.remove(raw_path)
+        os.replace(tmp_path, path)
+
+    # drop the least recently used entries until the cache fits in max_bytes
+    def evict(self, keep=None):
+        if self.max_bytes is None:
+            return
+
+        entries = []
+        for file_name in os.listdir(self.cache_path):
+            if file_name.endswith(".npy"):
+                path = os.path.join(self.cache_path, file_name)
+                stat = os.stat(path)
+                entries.append((stat.st_mtime, stat.st_size, path))
+
+        total_bytes = sum([size for _, size, _ in entries])
+        for _, size, path in sorted(entries):
+            if total_bytes <= self.max_bytes:
+                break
+            if path == keep:
+                continue
+            try:
+                os.remove(path)
+            except OSError:
+                continue
+            total_bytes -= size
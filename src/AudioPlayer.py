@@ -1,78 +1,91 @@
-import threading
-import time
-
 import torch
-import torchaudio
-import sounddevice as sd
-from torchaudio.transforms import Resample
+
+from .AudioReader import load_resampled
+from .PlaybackEngine import ArraySource, OverlaySource, PlaybackEngine
 
 
+# plays the original and the cover as the two tracks of one PlaybackEngine, every play call
+# returns at once and moves the running stream instead of opening a new one
 class AudioPlayer:
-    def __init__(self, original_path, cover_path, sample_rate=8000, use_gpu=False):
+    def __init__(self, original_path, cover_path, sample_rate=8000, use_gpu=False, cache=None, backend=None):
         self.device = "cuda" if use_gpu and torch.cuda.is_available() else "cpu"
 
         self.sample_rate = sample_rate
-        self.original, original_sr = torchaudio.load(original_path)
-        self.cover, cover_sr = torchaudio.load(cover_path)
-
-        self.original = self.original.to(self.device)
-        self.cover = self.cover.to(self.device)
-
-        if original_sr != sample_rate:
-            self.original = Resample(
-                original_sr, sample_rate, dtype=self.original.dtype
-            ).to(self.device)(self.original)
-        if cover_sr != sample_rate:
-            self.cover = Resample(
-                cover_sr, sample_rate, dtype=self.cover.dtype
-            ).to(self.device)(self.cover)
-
-        self.is_original_playing = False
-        self.is_cover_playing = False
-        self.current_millis = None
+        if cache is not None:
+            self.original = cache.load(original_path, sample_rate, device=self.device)
+            self.cover = cache.load(cover_path, sample_rate, device=self.device)
+        else:
+            self.original = self._load_audio(original_path)
+            self.cover = self._load_audio(cover_path)
+
+        self.channels = max(self.original.shape[0], self.cover.shape[0])
+        self.source = ArraySource([self.original, self.cover], self.channels)
+        self.engine = PlaybackEngine(sample_rate, self.channels, tracks=2, backend=backend)
+        self.engine.load(self.source)
+        self.overlay = None
+        self.play_start_sec = 0.0
+
+    def _load_audio(self, path):
+        return load_resampled(path, self.sample_rate).to(self.device)
+
+    @property
+    def is_original_playing(self):
+        return self.engine.playing and self.engine.gains[0] > 0
+
+    @property
+    def is_cover_playing(self):
+        return self.engine.playing and self.engine.gains[1] > 0
 
     def get_play_millis(self):
-        return int(round(time.time() * 1000)) - self.current_millis
+        return int(round((self.engine.position - self.play_start_sec) * 1000))
+
+    def _play_source(self, source, start_sec, end_sec, gains):
+        if self.engine.source is not source:
+            self.engine.load(source)
+        self.engine.set_gains(gains)
+        self.play_start_sec = start_sec
+        self.engine.play(start_sec, end_sec)
 
     def play_original(self, start_sec, end_sec, volume=1.0):
-        if self.is_original_playing or self.is_cover_playing:
-            return
-        self.is_original_playing = True
-        self._play(self._get_play_original(start_sec, end_sec).T.contiguous() * volume)
-        self.is_original_playing = False
+        self._play_source(self.source, start_sec, end_sec, [volume, 0.0])
 
     def play_cover(self, start_sec, end_sec, volume=1.0):
-        if self.is_original_playing or self.is_cover_playing:
-            return
-        self.is_cover_playing = True
-        self._play(self._get_play_cover(start_sec, end_sec).T.contiguous() * volume)
-        self.is_cover_playing = False
+        self._play_source(self.source, start_sec, end_sec, [0.0, volume])
 
+    # the original region is stretched over the cover region while it plays, set_ratio nudges it
     def play_both(self, original_start_sec, original_end_sec, cover_start_sec, cover_end_sec, original_vol=1.0,
                   cover_vol=1.0):
-        if self.is_original_playing or self.is_cover_playing:
-            return
+        cover_start_frame = round(cover_start_sec * self.sample_rate)
+        self.overlay = OverlaySource(
+            self.source.tracks[0], self.source.tracks[1], self.channels, round(original_start_sec * self.sample_rate),
+            cover_start_frame, round(cover_end_sec * self.sample_rate) - cover_start_frame,
+            (original_end_sec - original_start_sec) / (cover_end_sec - cover_start_sec)
+        )
+        self._play_source(self.overlay, 0.0, None, [original_vol, cover_vol])
 
-        self.is_original_playing = True
-        self.is_cover_playing = True
+    # original frames per cover frame of the running play_both, heard from the current position
+    def set_ratio(self, ratio):
+        if self.overlay is None or self.engine.source is not self.overlay:
+            raise ValueError("play_both is not playing")
+        frame = self.engine.clock_frame
+        self.overlay.set_ratio(ratio, frame)
+        self.engine.refill(frame)
 
-        original = self._get_play_original(original_start_sec, original_end_sec)
-        cover = self._get_play_cover(cover_start_sec, cover_end_sec)
+    # volume or crossfade of the running playback, faded over fade_seconds
+    def set_volumes(self, original_vol, cover_vol, fade_seconds=0.05):
+        self.engine.set_gains([original_vol, cover_vol], fade_seconds)
 
-        if original.shape[1] != cover.shape[1]:
-            factor = (cover_end_sec - cover_start_sec) / (original_end_sec - original_start_sec)
-            original = Resample(
-                self.sample_rate, int(self.sample_rate * factor), dtype=original.dtype
-            ).to(self.device)(original)
+    def seek(self, seconds):
+        self.engine.seek(seconds)
 
-        cover = (cover.T.contiguous() * cover_vol).to("cpu")
-        original = (original.T.contiguous() * original_vol).to("cpu")
-        original = torch.cat((original, torch.zeros(cover.shape[0] - original.shape[0], original.shape[1])), dim=0)
+    def pause(self):
+        self.engine.pause()
 
-        self._play(cover + original)
+    def resume(self):
+        self.engine.resume()
 
-        self.is_original_playing = False
-        self.is_cover_playing = False
+    def set_loop(self, start_sec=None, end_sec=None):
+        self.engine.set_loop(start_sec, end_sec)
 
     def _get_play_original(self, start_sec, end_sec):
         start_frame = round(start_sec * self.sample_rate)
@@ -84,20 +97,11 @@ class AudioPlayer:
         end_frame = round(end_sec * self.sample_rate)
         return self.cover[:, start_frame:end_frame]
 
-    def _play(self, wave):
-        self.current_millis = int(round(time.time() * 1000))
-
-        self.stream = sd.OutputStream(
-            channels=self.original.shape[0], finished_callback=self.stop, samplerate=self.sample_rate
-        )
-        self.stream.start()
-        self.stream.write(wave)
-        self.stream.stop()
-
-        self.current_millis = None
-
     def stop(self):
-        self.stream.stop()
+        self.engine.pause()
+
+    def close(self):
+        self.engine.close()
 
     def get_segment(self, original_start_sec, original_end_sec, cover_start_sec, cover_end_sec):
         return self._get_play_original(original_start_sec, original_end_sec).to("cpu"),\
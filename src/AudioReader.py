@@ -0,0 +1,135 @@
+import math
+
+import soundfile
+import torch
+
+from .AudioTrim import trim_silence_stream
+from .Transforms import get_resample
+
+
+# read an audio file as fixed-size [channels, frames] float32 chunks, consecutive chunks share
+# `overlap` frames. Decoding goes through soundfile, torchaudio 2.9 and later dropped info and
+# only loads through torchcodec
+class AudioReader:
+    def __init__(self, path, chunk_frames=2 ** 20, overlap=0):
+        if not 0 <= overlap < chunk_frames:
+            raise ValueError("overlap must be smaller than chunk_frames")
+
+        meta = soundfile.info(path)
+        self.path = path
+        self.chunk_frames = chunk_frames
+        self.overlap = overlap
+        self.sample_rate = meta.samplerate
+        self.num_frames = meta.frames
+        self.num_channels = meta.channels
+
+    def __iter__(self):
+        with soundfile.SoundFile(self.path) as file:
+            offset = 0
+            while True:
+                file.seek(offset)
+                waveform = torch.from_numpy(file.read(self.chunk_frames, dtype="float32", always_2d=True).T.copy())
+                if waveform.shape[-1] == 0 or (offset > 0 and waveform.shape[-1] <= self.overlap):
+                    return
+                yield waveform
+                if waveform.shape[-1] < self.chunk_frames:
+                    return
+                offset += self.chunk_frames - self.overlap
+
+
+# resample a stream of chunks with the same result as resampling the whole signal at once
+class ChunkedResampler:
+    def __init__(self, orig_sr, new_sr, dtype=torch.float32):
+        gcd = math.gcd(int(orig_sr), int(new_sr))
+        self.orig = int(orig_sr) // gcd
+        self.new = int(new_sr) // gcd
+        self.resample = get_resample(int(orig_sr), int(new_sr), dtype)
+
+        # input frames the sinc kernel reaches around a block, rounded up to whole blocks of `orig` frames
+        base = min(self.orig, self.new) * self.resample.rolloff
+        width = math.ceil(self.resample.lowpass_filter_width * self.orig / base)
+        self.context = math.ceil((width + self.orig) / self.orig) * self.orig
+
+        self.history = None
+        self.pending = None
+        self.total_in = 0
+        self.emitted = 0
+
+    def _run(self, waveform, keep_from, keep_frames):
+        out = self.resample(waveform)
+        start = keep_from * self.new // self.orig
+        return out[..., start:start + keep_frames]
+
+    def process(self, chunk):
+        self.pending = chunk if self.pending is None else torch.cat((self.pending, chunk), dim=-1)
+        self.total_in += chunk.shape[-1]
+        if self.history is None:
+            self.history = self.pending[..., :0]
+
+        ready = (self.pending.shape[-1] - self.context) // self.orig * self.orig
+        if ready <= 0:
+            return self.pending[..., :0]
+
+        window = torch.cat((self.history, self.pending[..., :ready + self.context]), dim=-1)
+        out = self._run(window, self.history.shape[-1], ready * self.new // self.orig)
+
+        self.history = torch.cat((self.history, self.pending[..., :ready]), dim=-1)[..., -self.context:]
+        self.pending = self.pending[..., ready:]
+        self.emitted += out.shape[-1]
+        return out
+
+    # the rest of the output, Resample on the whole signal gives ceil(total_in * new / orig) frames
+    def flush(self):
+        if self.pending is None or self.pending.shape[-1] == 0:
+            return None
+
+        window = torch.cat((self.history, self.pending), dim=-1)
+        out = self._run(window, self.history.shape[-1], -(-self.total_in * self.new // self.orig) - self.emitted)
+
+        self.history, self.pending = None, None
+        self.total_in, self.emitted = 0, 0
+        return out
+
+
+def mix_channels(waveform, num_channels=None):
+    if num_channels is None or waveform.shape[0] == num_channels:
+        return waveform
+    if num_channels == 1:
+        return torch.mean(waveform, dim=0, keepdim=True)
+    return waveform.expand(num_channels, -1) if waveform.shape[0] == 1 else waveform[:num_channels]
+
+
+def resample_chunks(chunks, orig_sr, new_sr):
+    if orig_sr == new_sr:
+        yield from chunks
+        return
+
+    resampler = None
+    for chunk in chunks:
+        if resampler is None:
+            resampler = ChunkedResampler(orig_sr, new_sr, dtype=chunk.dtype)
+        out = resampler.process(chunk)
+        if out.shape[-1] > 0:
+            yield out
+
+    if resampler is not None:
+        out = resampler.flush()
+        if out is not None and out.shape[-1] > 0:
+            yield out
+
+
+# decode, trim, remix and resample a file chunk by chunk, memory is bounded by chunk_frames
+def stream_audio(path, sample_rate, num_channels=None, trim=None, chunk_frames=2 ** 20):
+    reader = AudioReader(path, chunk_frames)
+    chunks = iter(reader)
+    if trim:
+        chunks = trim_silence_stream(chunks, reader.sample_rate, **(trim if isinstance(trim, dict) else {}))
+    chunks = (mix_channels(chunk, num_channels) for chunk in chunks)
+    return resample_chunks(chunks, reader.sample_rate, sample_rate)
+
+
+def load_resampled(path, sample_rate, num_channels=None, trim=None, chunk_frames=2 ** 20):
+    chunks = list(stream_audio(path, sample_rate, num_channels, trim, chunk_frames))
+    if not chunks:
+        return torch.zeros(num_channels or soundfile.info(path).channels, 0)
+    return torch.cat(chunks, dim=-1)
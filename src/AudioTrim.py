@@ -0,0 +1,97 @@
+import math
+
+import torch
+
+
+# cut leading and trailing digital silence
+def trim_empty(waveform):
+    sound = waveform.pow(2).sum(0) > 0
+    if not bool(sound.any()):
+        return waveform[:, :0]
+
+    start_idx = int(torch.argmax(sound.int()))
+    end_idx = waveform.shape[-1] - int(torch.argmax(sound.flip(0).int()))
+
+    return waveform[:, start_idx:end_idx]
+
+
+# cut leading and trailing silence, a frame is silent when its rms is below threshold_db (dBFS);
+# silences shorter than min_silence_seconds are kept and keep_seconds of each cut silence remain
+def trim_silence(waveform, sample_rate, threshold_db=-60.0, min_silence_seconds=0.5, keep_seconds=0.1,
+                 frame_seconds=0.02):
+    chunks = list(trim_silence_stream(
+        [waveform], sample_rate, threshold_db, min_silence_seconds, keep_seconds, frame_seconds
+    ))
+    return torch.cat(chunks, dim=-1) if chunks else waveform[:, :0]
+
+
+# trim_silence for a stream of [channels, frames] chunks, only silence that may still be cut is held back
+def trim_silence_stream(chunks, sample_rate, threshold_db=-60.0, min_silence_seconds=0.5, keep_seconds=0.1,
+                        frame_seconds=0.02):
+    frame = max(1, int(round(frame_seconds * sample_rate)))
+    min_frames = math.ceil(min_silence_seconds * sample_rate / frame)
+    keep_frames = int(round(keep_seconds * sample_rate / frame))
+    threshold = 10 ** (threshold_db / 10)
+
+    started = False
+    leading_frames = 0
+    held = []
+    remainder = None
+
+    def is_loud(frames):
+        power = frames.pow(2).mean(dim=(0, 2)) if frames.ndim == 3 else frames.pow(2).mean().unsqueeze(0)
+        return power > threshold
+
+    def held_frames():
+        return sum([math.ceil(item.shape[-1] / frame) for item in held])
+
+    def cut(items, num_frames, from_end):
+        waveform = torch.cat(items, dim=-1)
+        return waveform[:, -num_frames * frame:] if from_end else waveform[:, :num_frames * frame]
+
+    def process(waveform, loud):
+        nonlocal started, leading_frames, held
+        num_frames = len(loud)
+        if not bool(loud.any()):
+            held.append(waveform)
+            if not started:
+                leading_frames += num_frames
+                held = [cut(held, max(min_frames, keep_frames), from_end=True)] if keep_frames or min_frames else []
+            return
+
+        first = int(torch.argmax(loud.int()))
+        last = num_frames - int(torch.argmax(loud.flip(0).int()))
+
+        if not started:
+            leading_frames += first
+            held.append(waveform[:, :first * frame])
+            if leading_frames > 0:
+                keep = leading_frames if leading_frames < min_frames else keep_frames
+                if keep > 0:
+                    yield cut(held, keep, from_end=True)
+            yield waveform[:, first * frame:last * frame]
+            started = True
+        else:
+            yield from held
+            yield waveform[:, :last * frame]
+
+        held = [waveform[:, last * frame:]] if last < num_frames else []
+
+    for chunk in chunks:
+        waveform = chunk if remainder is None else torch.cat((remainder, chunk), dim=-1)
+        num_frames = waveform.shape[-1] // frame
+        remainder = waveform[:, num_frames * frame:]
+        if num_frames == 0:
+            continue
+
+        waveform = waveform[:, :num_frames * frame]
+        loud = is_loud(waveform.reshape(waveform.shape[0], num_frames, frame))
+        yield from process(waveform, loud)
+
+    if remainder is not None and remainder.shape[-1] > 0:
+        yield from process(remainder, is_loud(remainder))
+
+    if started and held:
+        trailing_frames = held_frames()
+        yield torch.cat(held, dim=-1) if trailing_frames < min_frames else cut(held, keep_frames, from_end=False)
+
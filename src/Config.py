@@ -2,6 +2,8 @@ import os.path
 import threading
 import json
 
+from .Rendition import DEFAULT_RENDITIONS
+
 
 # make a class for config with threading lock
 class Config:
@@ -56,3 +58,36 @@ class Config:
             if not os.path.isdir(path):
                 os.mkdir(path)
         return self._config["audio_path"]
+
+    # get source audio cache path, audio_path/sources unless set. audio_spliter/config.json points
+    # path.source_cache at the same directory so the gui and the generator share decodes
+    @property
+    def source_cache_path(self):
+        path = os.path.abspath(self._config.get("source_cache_path") or os.path.join(self.audio_path, "sources"))
+        if not os.path.isdir(path):
+            os.makedirs(path)
+        return path
+
+    # size cap of the download intermediates in audio_path/__cache__
+    @property
+    def media_cache_max_bytes(self):
+        return int(self._config.get("media_cache_gigabytes", 5) * 1024 ** 3)
+
+    # derived files every download is decoded into, see Rendition.DEFAULT_RENDITIONS
+    @property
+    def renditions(self):
+        return self._config.get("renditions", DEFAULT_RENDITIONS)
+
+    # sample rate audio is played at, the rendition closest to it is loaded
+    @property
+    def playback_sample_rate(self):
+        return self._config.get("playback_sample_rate", 8000)
+
+    # video metadata older than this is fetched again
+    @property
+    def metadata_ttl_seconds(self):
+        return self._config.get("metadata_ttl_hours", 24) * 3600
+
+    @property
+    def metadata_store_path(self):
+        return os.path.join(self.audio_path, "metadata.sqlite")
@@ -0,0 +1,173 @@
+import json
+import os
+import threading
+import time
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+
+from .MediaCache import MediaCache
+from .Rendition import DEFAULT_RENDITIONS, describe_renditions, has_renditions
+from .YouTubeMP3 import YouTubeVideo, transcode
+
+
+class PytubeDownloader:
+    @staticmethod
+    def download(video, output_dir, filename):
+        video.video.streams.filter(only_audio=True).first().download(
+            output_path=output_dir, filename=filename, skip_existing=True
+        )
+        return os.path.join(output_dir, filename)
+
+
+# ingest many videos into audio_path/data and audio_path/config. Every item goes through
+# metadata, download and transcode into its renditions; each stage has its own concurrency limit (transcodes run in
+# a process pool), at most max_pending items are in flight so a lazy item iterator is consumed
+# as work frees up, failed stages are retried with backoff, and finished ids are appended to a
+# done-set so reruns skip them. Renditions enter through the media cache, which revalidates them.
+# progress gets a dict per stage event
+class IngestService:
+    def __init__(self, audio_path, downloader=None, resolver=None, transcoder=transcode, metadata_workers=4,
+                 download_workers=4, transcode_workers=2, max_pending=16, retries=2, retry_delay=1.0,
+                 progress=None, media_cache=None, renditions=None, metadata_store=None):
+        self.audio_path = audio_path
+        self.media_cache = media_cache or MediaCache(audio_path)
+        self.cache_path = self.media_cache.cache_path
+        self.config_path = os.path.join(audio_path, "config")
+        self.done_path = os.path.join(audio_path, "ingest_done.jsonl")
+        if not os.path.isdir(self.config_path):
+            os.makedirs(self.config_path)
+
+        self.downloader = downloader or PytubeDownloader()
+        self.resolver = resolver or (lambda url: YouTubeVideo.get_video_from_url(url, metadata_store))
+        self.transcoder = transcoder
+        self.renditions = renditions or DEFAULT_RENDITIONS
+        self.transcode_workers = transcode_workers
+        self.max_pending = max(max_pending, 1)
+        self.retries = retries
+        self.retry_delay = retry_delay
+        self.progress = progress
+
+        self.stage_slots = {
+            "metadata": threading.BoundedSemaphore(metadata_workers),
+            "download": threading.BoundedSemaphore(download_workers),
+            "transcode": threading.BoundedSemaphore(transcode_workers)
+        }
+        self.lock = threading.Lock()
+        self.done_ids, self.done_urls = self._load_done()
+        self.counts = {"done": 0, "skipped": 0, "failed": 0}
+
+    def _load_done(self):
+        ids, urls = set(), {}
+        if os.path.exists(self.done_path):
+            with open(self.done_path, "r", encoding="utf-8") as file:
+                for line in file:
+                    if line.strip():
+                        entry = json.loads(line)
+                        ids.add(entry["id"])
+                        if entry.get("url"):
+                            urls[entry["url"]] = entry["id"]
+        return ids, urls
+
+    def _mark_done(self, video_id, url):
+        with self.lock:
+            self.done_ids.add(video_id)
+            if url:
+                self.done_urls[url] = video_id
+            with open(self.done_path, "a", encoding="utf-8") as file:
+                file.write(json.dumps({"id": video_id, "url": url}) + "\n")
+
+    def _report(self, item, stage, status, error=None):
+        if self.progress is None:
+            return
+        with self.lock:
+            event = dict(self.counts, item=item, stage=stage, status=status, error=error)
+        self.progress(event)
+
+    # the media cache is the authority, it also sees what other workers sharing it finished
+    def is_done(self, video_id):
+        return has_renditions(self.media_cache.get(video_id), self.renditions) \
+            and os.path.exists(os.path.join(self.config_path, video_id + ".json"))
+
+    def _stage(self, item, stage, function, *args):
+        for attempt in range(self.retries + 1):
+            with self.stage_slots[stage]:
+                self._report(item, stage, "start")
+                try:
+                    result = function(*args)
+                    self._report(item, stage, "done")
+                    return result
+                except Exception as e:
+                    if attempt == self.retries:
+                        raise
+                    self._report(item, stage, "retry", repr(e))
+            time.sleep(self.retry_delay * 2 ** attempt)
+
+    # resolving a url does not go to the network, reading the metadata does; it is fetched in the
+    # metadata stage, through the metadata store, so save_config only writes what is already there
+    def _fetch_metadata(self, item):
+        video = item if isinstance(item, YouTubeVideo) else self.resolver(item)
+        video.metadata
+        return video
+
+    def _ingest(self, item, transcode_pool):
+        url = item if isinstance(item, str) else None
+        if url is not None and url in self.done_urls and self.is_done(self.done_urls[url]):
+            return None
+
+        video = self._stage(item, "metadata", self._fetch_metadata, item)
+        with self.media_cache.lock(video.id):
+            if self.is_done(video.id):
+                return None
+
+            download_path = self._stage(
+                video.id, "download", self.downloader.download, video, self.cache_path, video.id + ".mp4"
+            )
+            self.media_cache.touch(download_path)
+            transcoded_paths = self._stage(
+                video.id, "transcode",
+                lambda: transcode_pool.submit(
+                    self.transcoder, download_path, self.cache_path, video.id, self.renditions
+                ).result()
+            )
+            entries = self.media_cache.put(video.id, transcoded_paths)
+
+            config_path = os.path.join(self.config_path, video.id + ".json")
+            video.save_config(config_path, describe_renditions(entries, self.renditions))
+
+        self._mark_done(video.id, url)
+        return video.id, {name: self.media_cache.path(entry["file"]) for name, entry in entries.items()}, config_path
+
+    def _finish(self, item, future, results, failures, pending):
+        try:
+            result = future.result()
+            with self.lock:
+                if result is None:
+                    self.counts["skipped"] += 1
+                else:
+                    self.counts["done"] += 1
+                    results.append(result)
+            self._report(item, "item", "skipped" if result is None else "done")
+        except Exception as e:
+            with self.lock:
+                self.counts["failed"] += 1
+                failures.append((item, repr(e)))
+            self._report(item, "item", "failed", repr(e))
+        finally:
+            pending.release()
+
+    # items: urls or YouTubeVideo objects, any iterable; returns (results, failures) where results
+    # holds (video id, {rendition name: path}, config path) of the newly ingested videos
+    def run(self, items):
+        results, failures = [], []
+        pending = threading.BoundedSemaphore(self.max_pending)
+
+        with ProcessPoolExecutor(self.transcode_workers) as transcode_pool, \
+                ThreadPoolExecutor(self.max_pending) as item_pool:
+            for item in items:
+                pending.acquire()
+                future = item_pool.submit(self._ingest, item, transcode_pool)
+                future.add_done_callback(
+                    lambda done, item=item: self._finish(item, done, results, failures, pending)
+                )
+
+        self.media_cache.evict()
+        return results, failures
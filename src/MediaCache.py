@@ -0,0 +1,262 @@
+import hashlib
+import json
+import os
+import struct
+import time
+
+import soundfile
+
+from .Rendition import LEGACY_RENDITION
+
+
+# exclusive lock on a file shared by threads and processes, flock on posix and msvcrt on windows
+class FileLock:
+    def __init__(self, path):
+        self.path = path
+        self.file = None
+
+    def __enter__(self):
+        self.file = open(self.path, "a+b")
+        if os.name == "nt":
+            import msvcrt
+            while True:
+                try:
+                    self.file.seek(0)
+                    msvcrt.locking(self.file.fileno(), msvcrt.LK_LOCK, 1)
+                    break
+                except OSError:
+                    time.sleep(0.05)
+        else:
+            import fcntl
+            fcntl.flock(self.file.fileno(), fcntl.LOCK_EX)
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if os.name == "nt":
+            import msvcrt
+            self.file.seek(0)
+            msvcrt.locking(self.file.fileno(), msvcrt.LK_UNLCK, 1)
+        else:
+            import fcntl
+            fcntl.flock(self.file.fileno(), fcntl.LOCK_UN)
+        self.file.close()
+        self.file = None
+
+
+def file_hash(path, block_size=2 ** 20):
+    sha1 = hashlib.sha1()
+    with open(path, "rb") as file:
+        for block in iter(lambda: file.read(block_size), b""):
+            sha1.update(block)
+    return sha1.hexdigest()
+
+
+# a RIFF wav whose RIFF and data chunk sizes agree with the file size; ffmpeg writes placeholder
+# sizes first and patches them on exit, so a killed transcode leaves a file that still decodes
+def wav_sizes_match(path):
+    file_size = os.path.getsize(path)
+    with open(path, "rb") as file:
+        header = file.read(12)
+        if len(header) < 12 or header[:4] != b"RIFF" or header[8:12] != b"WAVE":
+            return False
+        if struct.unpack("<I", header[4:8])[0] + 8 != file_size:
+            return False
+
+        position = 12
+        while position + 8 <= file_size:
+            file.seek(position)
+            chunk_id, chunk_size = struct.unpack("<4sI", file.read(8))
+            if chunk_id == b"data":
+                return position + 8 + chunk_size <= file_size
+            position += 8 + chunk_size + (chunk_size & 1)
+    return False
+
+
+# the renditions under audio_path/data with a manifest of their size, hash, duration, sample rate
+# and codec per video. Files only enter through put, after they were decoded and moved in
+# atomically, or are adopted as LEGACY_RENDITION when get first sees a video with only a valid
+# data/{id}.wav from before the manifest; get revalidates them (size and mtime, a rehash and probe when they changed) so
+# truncated or edited files are fetched again. Identical content is stored once through hard
+# links, and the download intermediates in audio_path/__cache__ are evicted least recently used
+# first above max_cache_bytes
+class MediaCache:
+    def __init__(self, audio_path, max_cache_bytes=5 * 1024 ** 3):
+        self.audio_path = audio_path
+        self.data_path = os.path.join(audio_path, "data")
+        self.cache_path = os.path.join(audio_path, "__cache__")
+        self.manifest_path = os.path.join(audio_path, "media_manifest.json")
+        self.lock_path = os.path.join(audio_path, "media_manifest.lock")
+        self.max_cache_bytes = max_cache_bytes
+        for path in (self.data_path, self.cache_path):
+            if not os.path.isdir(path):
+                os.makedirs(path)
+
+    def path(self, file_name):
+        return os.path.join(self.data_path, file_name)
+
+    # held while a video is downloaded and transcoded, so workers sharing the cache do it once
+    def lock(self, video_id):
+        return FileLock(os.path.join(self.cache_path, video_id + ".lock"))
+
+    def _load_manifest(self):
+        if not os.path.exists(self.manifest_path):
+            return {}
+        with open(self.manifest_path, "r", encoding="utf-8") as file:
+            return json.load(file)
+
+    def _save_manifest(self, manifest):
+        tmp_path = self.manifest_path + ".tmp"
+        with open(tmp_path, "w", encoding="utf-8") as file:
+            json.dump(manifest, file, indent=2)
+        os.replace(tmp_path, self.manifest_path)
+
+    @staticmethod
+    def probe(path):
+        if path.lower().endswith(".wav") and not wav_sizes_match(path):
+            raise ValueError(f"{path} has riff sizes that do not match the file, it was not finished")
+        meta = soundfile.info(path)
+        if meta.frames <= 0:
+            raise ValueError(f"{path} has no audio frames")
+        stat = os.stat(path)
+        return {
+            "file": os.path.basename(path),
+            "size": stat.st_size,
+            "mtime": stat.st_mtime,
+            "sha1": file_hash(path),
+            "duration": meta.frames / meta.samplerate,
+            "sample_rate": meta.samplerate,
+            "channels": meta.channels,
+            "codec": f"{meta.format}/{meta.subtype}"
+        }
+
+    # {rendition name: manifest entry} of a video
+    def entry(self, video_id):
+        return self._load_manifest().get(video_id)
+
+    def _valid(self, entry):
+        path = self.path(entry["file"])
+        if not os.path.exists(path):
+            return None
+        stat = os.stat(path)
+        if stat.st_size == entry["size"] and stat.st_mtime == entry["mtime"]:
+            return entry
+
+        try:
+            probed = self.probe(path)
+        except Exception:
+            return None
+        return probed if probed["sha1"] == entry["sha1"] else None
+
+    # probe data/{id}.wav of a video missing from the manifest and enter it as LEGACY_RENDITION,
+    # returns the video's entries or None when there is no such file, it does not decode or its
+    # riff sizes show an unfinished write
+    def adopt(self, video_id):
+        path = self.path(video_id + ".wav")
+        if not os.path.exists(path):
+            return None
+        try:
+            probed = self.probe(path)
+        except Exception:
+            return None
+
+        with FileLock(self.lock_path):
+            manifest = self._load_manifest()
+            if video_id not in manifest:
+                manifest[video_id] = {LEGACY_RENDITION: probed}
+                self._save_manifest(manifest)
+        return manifest[video_id]
+
+    # {rendition name: path} of a video while every rendition validates, or None after dropping
+    # the video when one is missing or changed
+    def get(self, video_id):
+        entries = self.entry(video_id) or self.adopt(video_id)
+        if entries is None:
+            return None
+        if all(self._valid(entry) is entry for entry in entries.values()):
+            return {name: self.path(entry["file"]) for name, entry in entries.items()}
+
+        with FileLock(self.lock_path):
+            manifest = self._load_manifest()
+            if video_id not in manifest:
+                return None
+            valid = {name: self._valid(entry) for name, entry in manifest[video_id].items()}
+            if any(entry is None for entry in valid.values()):
+                del manifest[video_id]
+                valid = None
+            else:
+                manifest[video_id] = valid
+            self._save_manifest(manifest)
+        return None if valid is None else {name: self.path(entry["file"]) for name, entry in valid.items()}
+
+    def _move_in(self, manifest, video_id, entry, source_path):
+        path = self.path(entry["file"])
+        duplicate = next((
+            other_entry for other, entries in manifest.items() for other_entry in entries.values()
+            if other != video_id and other_entry["sha1"] == entry["sha1"] and self._valid(other_entry)
+        ), None)
+
+        tmp_path = path + ".tmp"
+        if duplicate is not None:
+            try:
+                if os.path.exists(tmp_path):
+                    os.remove(tmp_path)
+                os.link(self.path(duplicate["file"]), tmp_path)
+                os.remove(source_path)
+            except OSError:
+                os.replace(source_path, tmp_path)
+        else:
+            os.replace(source_path, tmp_path)
+        # renaming onto a hard link of the same file is a no-op that would leave tmp_path behind
+        if os.path.exists(path) and os.path.samefile(path, tmp_path):
+            os.remove(tmp_path)
+        else:
+            os.replace(tmp_path, path)
+
+        stat = os.stat(path)
+        return dict(entry, size=stat.st_size, mtime=stat.st_mtime)
+
+    # move the finished renditions of a video into the cache, sources is {rendition name: path} and
+    # every file must decode; files of renditions the video no longer has are removed. Returns
+    # {rendition name: manifest entry}
+    def put(self, video_id, sources):
+        probed = {name: self.probe(source_path) for name, source_path in sources.items()}
+
+        with FileLock(self.lock_path):
+            manifest = self._load_manifest()
+            entries = {
+                name: self._move_in(manifest, video_id, entry, sources[name]) for name, entry in probed.items()
+            }
+
+            files = {entry["file"] for entry in entries.values()}
+            for old_entry in manifest.get(video_id, {}).values():
+                if old_entry["file"] not in files and os.path.exists(self.path(old_entry["file"])):
+                    os.remove(self.path(old_entry["file"]))
+
+            manifest[video_id] = entries
+            self._save_manifest(manifest)
+        return entries
+
+    def touch(self, path):
+        if os.path.exists(path):
+            os.utime(path)
+
+    # oldest intermediates go first until __cache__ fits in max_cache_bytes, lock files stay
+    def evict(self):
+        files = []
+        for name in os.listdir(self.cache_path):
+            path = os.path.join(self.cache_path, name)
+            if name.endswith(".lock") or not os.path.isfile(path):
+                continue
+            stat = os.stat(path)
+            files.append((stat.st_mtime, stat.st_size, path))
+
+        total = sum([size for _, size, _ in files])
+        for _, size, path in sorted(files):
+            if total <= self.max_cache_bytes:
+                break
+            try:
+                os.remove(path)
+                total -= size
+            except OSError:
+                pass
+        return total
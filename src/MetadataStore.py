@@ -0,0 +1,48 @@
+import json
+import sqlite3
+import time
+from contextlib import closing
+
+
+# YouTubeVideo.to_dict fields per video id in sqlite, rows older than ttl_seconds count as missing.
+# Every call opens its own connection, so threads and processes can share one store
+class MetadataStore:
+    def __init__(self, path, ttl_seconds=24 * 3600):
+        self.path = path
+        self.ttl_seconds = ttl_seconds
+        with closing(self._connect()) as connection, connection:
+            connection.execute(
+                "CREATE TABLE IF NOT EXISTS videos (id TEXT PRIMARY KEY, data TEXT NOT NULL, fetched REAL NOT NULL)"
+            )
+
+    def _connect(self):
+        return sqlite3.connect(self.path, timeout=30)
+
+    def get(self, video_id):
+        return self.get_many([video_id]).get(video_id)
+
+    # {video id: fields} of the fresh videos among video_ids, one query for a whole page
+    def get_many(self, video_ids):
+        video_ids = list(video_ids)
+        if not video_ids:
+            return {}
+        with closing(self._connect()) as connection:
+            rows = connection.execute(
+                f"SELECT id, data FROM videos WHERE fetched >= ? AND id IN ({', '.join('?' * len(video_ids))})",
+                [time.time() - self.ttl_seconds] + video_ids
+            ).fetchall()
+        return {video_id: json.loads(data) for video_id, data in rows}
+
+    def put(self, video_id, fields):
+        with closing(self._connect()) as connection, connection:
+            connection.execute(
+                "INSERT OR REPLACE INTO videos (id, data, fetched) VALUES (?, ?, ?)",
+                (video_id, json.dumps(fields, ensure_ascii=False), time.time())
+            )
+
+    # drop the stale rows, returns how many
+    def purge(self):
+        with closing(self._connect()) as connection, connection:
+            return connection.execute(
+                "DELETE FROM videos WHERE fetched < ?", (time.time() - self.ttl_seconds,)
+            ).rowcount
@@ -0,0 +1,390 @@
+import threading
+import time
+from functools import lru_cache
+
+import numpy as np
+import torch
+
+from .AudioReader import mix_channels
+
+
+# single producer, single consumer ring of frames: the producer only moves write_index and the
+# consumer only read_index, so neither side takes a lock. Every slot keeps the source frame it
+# holds and the epoch it was produced in, a seek bumps the epoch and the consumer drops older slots
+class RingBuffer:
+    def __init__(self, capacity, width):
+        self.capacity = capacity
+        self.data = np.zeros((capacity, width), dtype=np.float32)
+        self.positions = np.zeros(capacity, dtype=np.int64)
+        self.epochs = np.zeros(capacity, dtype=np.int64)
+        self.write_index = 0
+        self.read_index = 0
+
+    def readable(self):
+        return self.write_index - self.read_index
+
+    def writable(self):
+        return self.capacity - self.readable()
+
+    def _slots(self, start, count):
+        return (np.arange(start, start + count) % self.capacity) if count else np.zeros(0, dtype=np.int64)
+
+    def write(self, frames, positions, epoch):
+        count = min(len(frames), self.writable())
+        slots = self._slots(self.write_index, count)
+        self.data[slots] = frames[:count]
+        self.positions[slots] = positions[:count]
+        self.epochs[slots] = epoch
+        self.write_index += count
+        return count
+
+    # skip the slots at the front that belong to an older epoch
+    def discard_stale(self, epoch):
+        slots = self._slots(self.read_index, self.readable())
+        current = np.flatnonzero(self.epochs[slots] == epoch)
+        self.read_index += int(current[0]) if len(current) else len(slots)
+
+    def read(self, count):
+        slots = self._slots(self.read_index, min(count, self.readable()))
+        data, positions = self.data[slots], self.positions[slots]
+        self.read_index += len(slots)
+        return data, positions
+
+
+# [channels, frames] waveform as a [frames, channels] float32 array on the cpu
+def frames_major(waveform, channels):
+    return np.ascontiguousarray(mix_channels(torch.as_tensor(waveform), channels).to("cpu", torch.float32).numpy().T)
+
+
+# tracks of [channels, frames] waveforms on one timeline, read as [frames, tracks * channels]
+# float32 blocks; tracks shorter than the longest one read as silence past their end
+class ArraySource:
+    def __init__(self, tracks, channels):
+        self.tracks = [frames_major(track, channels) for track in tracks]
+        self.channels = channels
+        self.num_frames = max([track.shape[0] for track in self.tracks])
+
+    def read(self, position, count):
+        block = np.zeros((count, len(self.tracks) * self.channels), dtype=np.float32)
+        for i, track in enumerate(self.tracks):
+            part = track[position:position + count]
+            block[:len(part), i * self.channels:(i + 1) * self.channels] = part
+        return block
+
+
+# windowed sinc interpolation kernels for fractional delays of 0..1 in `phases` steps, a row per
+# phase over the taps floor(t) - half_width + 1 .. floor(t) + half_width; cutoff below 1 lowpasses
+# for reading faster than the sample rate
+@lru_cache(maxsize=32)
+def get_fractional_kernels(cutoff, phases=256, half_width=8):
+    offsets = np.arange(-half_width + 1, half_width + 1)
+    x = offsets[None, :] - (np.arange(phases + 1) / phases)[:, None]
+    kernels = cutoff * np.sinc(cutoff * x) * (0.5 + 0.5 * np.cos(np.pi * np.clip(x / half_width, -1, 1)))
+    return (kernels / kernels.sum(axis=1, keepdims=True)).astype(np.float32)
+
+
+# the cover from cover_start_frame, with the original laid over it at `ratio` original frames per
+# cover frame. The original is resampled block by block with cached kernels as it is read, so
+# playing starts at once, and set_ratio re-anchors the mapping at a frame to change it live.
+# Like Resample, the rate change also shifts the pitch
+class OverlaySource:
+    def __init__(self, original, cover, channels, original_start_frame, cover_start_frame, num_frames, ratio=1.0,
+                 phases=256, half_width=8):
+        self.original = original
+        self.cover = cover
+        self.channels = channels
+        self.cover_start_frame = cover_start_frame
+        self.num_frames = num_frames
+        self.phases = phases
+        self.half_width = half_width
+        # (source frame, original frame at it, ratio), replaced as a whole by set_ratio
+        self._anchor = (0, float(original_start_frame), float(ratio))
+
+    @property
+    def ratio(self):
+        return self._anchor[2]
+
+    def set_ratio(self, ratio, position):
+        anchor_position, anchor_time, old_ratio = self._anchor
+        self._anchor = (position, anchor_time + (position - anchor_position) * old_ratio, float(ratio))
+
+    def read(self, position, count):
+        block = np.zeros((count, 2 * self.channels), dtype=np.float32)
+        start = self.cover_start_frame + position
+        part = self.cover[start:start + count]
+        block[:len(part), self.channels:] = part
+
+        anchor_position, anchor_time, ratio = self._anchor
+        times = anchor_time + (np.arange(position, position + count) - anchor_position) * ratio
+        base = np.floor(times).astype(np.int64)
+        kernels = get_fractional_kernels(round(min(1.0, 1.0 / ratio), 2), self.phases, self.half_width)
+        kernels = kernels[np.round((times - base) * self.phases).astype(np.int64)]
+
+        taps = base[:, None] + np.arange(-self.half_width + 1, self.half_width + 1)[None, :]
+        inside = (taps >= 0) & (taps < len(self.original))
+        samples = self.original[np.clip(taps, 0, len(self.original) - 1)] * inside[:, :, None]
+        block[:, :self.channels] = np.einsum("ft,ftc->fc", kernels, samples)
+        return block
+
+
+# no device: the callback is driven from a thread at real time pace, or only by pump() when
+# realtime is off, and what it rendered is kept in `output` when record is set
+class NullBackend:
+    latency = 0.0
+
+    def __init__(self, realtime=True, record=False):
+        self.realtime = realtime
+        self.record = record
+        self.output = []
+        self.callback = None
+        self.thread = None
+        self.closed = threading.Event()
+
+    def open(self, sample_rate, channels, blocksize, callback):
+        self.sample_rate, self.channels, self.blocksize = sample_rate, channels, blocksize
+        self.callback = callback
+        if self.realtime:
+            self.thread = threading.Thread(target=self._run, daemon=True)
+            self.thread.start()
+
+    def _run(self):
+        next_time = time.perf_counter()
+        while not self.closed.is_set():
+            self.pump()
+            next_time += self.blocksize / self.sample_rate
+            self.closed.wait(max(0.0, next_time - time.perf_counter()))
+
+    def pump(self, blocks=1):
+        for _ in range(blocks):
+            outdata = np.zeros((self.blocksize, self.channels), dtype=np.float32)
+            self.callback(outdata, self.blocksize)
+            if self.record:
+                self.output.append(outdata)
+
+    def recorded(self):
+        return np.concatenate(self.output) if self.output else np.zeros((0, self.channels), dtype=np.float32)
+
+    def close(self):
+        self.closed.set()
+        if self.thread is not None:
+            self.thread.join()
+
+
+# a persistent sounddevice output stream, sounddevice is only imported once a device is opened
+class SoundDeviceBackend:
+    def __init__(self, device=None, latency="low"):
+        self.device = device
+        self.requested_latency = latency
+        self.stream = None
+
+    def open(self, sample_rate, channels, blocksize, callback):
+        import sounddevice as sd
+
+        def stream_callback(outdata, frames, time_info, status):
+            callback(outdata, frames)
+
+        self.stream = sd.OutputStream(
+            samplerate=sample_rate, channels=channels, blocksize=blocksize, dtype="float32", device=self.device,
+            latency=self.requested_latency, callback=stream_callback
+        )
+        self.stream.start()
+
+    @property
+    def latency(self):
+        return self.stream.latency if self.stream is not None else 0.0
+
+    def close(self):
+        if self.stream is not None:
+            self.stream.stop()
+            self.stream.close()
+            self.stream = None
+
+
+# plays a source through one output stream that stays open: a producer thread renders the source
+# into the ring buffer and the audio callback only mixes the tracks with their gains, so play,
+# seek, pause, loop and volume or crossfade changes never reopen the device or block the caller.
+# position comes from the frames the callback has handed to the device, less the output latency
+class PlaybackEngine:
+    def __init__(self, sample_rate, channels, tracks=1, backend=None, blocksize=256, buffer_seconds=0.1):
+        self.sample_rate = sample_rate
+        self.channels = channels
+        self.tracks = tracks
+        self.blocksize = blocksize
+        self.ring = RingBuffer(max(int(buffer_seconds * sample_rate), 2 * blocksize), tracks * channels)
+
+        # (epoch, source, start frame, end frame), replaced as a whole by load, play and seek
+        self._cursor = (0, None, 0, 0)
+        self._loop = None
+        self._playing = False
+        self._drained_epoch = -1
+        self._clock_frame = 0
+        self.finished = threading.Event()
+
+        # (version, target gains, fade frames), the callback ramps its gains towards the target
+        self._fade = (0, np.ones(tracks, dtype=np.float32), 0)
+        self._fade_seen = 0
+        self._gains = np.ones(tracks, dtype=np.float32)
+        self._ramp_target = self._gains
+        self._ramp_left = 0
+
+        self._wake = threading.Event()
+        self._closed = False
+        self._producer = threading.Thread(target=self._produce, daemon=True)
+        self._producer.start()
+
+        self.backend = backend or SoundDeviceBackend()
+        self.backend.open(sample_rate, channels, blocksize, self._callback)
+
+    def _frame(self, seconds):
+        return max(0, int(round(seconds * self.sample_rate)))
+
+    def _move(self, source, start_frame, end_frame):
+        self._cursor = (self._cursor[0] + 1, source, start_frame, end_frame)
+        self._clock_frame = start_frame
+        self.finished.clear()
+        self._wake.set()
+
+    # a source reads [frames, tracks * channels] blocks and has num_frames
+    def load(self, source):
+        if source.read(0, 0).shape[1] != self.tracks * self.channels:
+            raise ValueError(f"source must have {self.tracks} tracks of {self.channels} channels")
+        self._playing = False
+        self._move(source, 0, source.num_frames)
+
+    # play start_sec to end_sec of the loaded source, end_sec None plays to its end
+    def play(self, start_sec=0.0, end_sec=None):
+        source = self.source
+        if source is None:
+            raise ValueError("no source loaded")
+        end_frame = source.num_frames if end_sec is None else min(self._frame(end_sec), source.num_frames)
+        self._move(source, self._frame(start_sec), end_frame)
+        self._playing = True
+
+    def seek(self, seconds):
+        _, source, _, end_frame = self._cursor
+        self._move(source, self._frame(seconds), end_frame)
+
+    def pause(self):
+        self._playing = False
+
+    def resume(self):
+        if self.source is not None:
+            self._playing = True
+
+    # the buffer is refilled from the frame being heard, so a loop around it takes effect at once;
+    # end_sec None loops at the end of the source
+    def set_loop(self, start_sec=None, end_sec=None):
+        self._loop = None if start_sec is None else (
+            self._frame(start_sec), None if end_sec is None else self._frame(end_sec)
+        )
+        if self._loop is not None:
+            self.refill()
+        self._wake.set()
+
+    # render the source again from frame (default the one being heard), after it changed live
+    def refill(self, frame=None):
+        if self.source is not None:
+            self._move(self.source, self._clock_frame if frame is None else frame, self._cursor[3])
+
+    def set_gains(self, gains, fade_seconds=0.0):
+        gains = np.asarray(gains, dtype=np.float32)
+        if gains.shape != (self.tracks,):
+            raise ValueError(f"expected {self.tracks} gains")
+        self._fade = (self._fade[0] + 1, gains, self._frame(fade_seconds))
+
+    def crossfade(self, track, fade_seconds, volume=1.0):
+        gains = np.zeros(self.tracks, dtype=np.float32)
+        gains[track] = volume
+        self.set_gains(gains, fade_seconds)
+
+    @property
+    def source(self):
+        return self._cursor[1]
+
+    @property
+    def gains(self):
+        return self._fade[1]
+
+    @property
+    def playing(self):
+        return self._playing
+
+    @property
+    def clock_frame(self):
+        return self._clock_frame
+
+    @property
+    def position(self):
+        latency_frames = int(self.backend.latency * self.sample_rate)
+        return max(0, self._clock_frame - latency_frames) / self.sample_rate
+
+    def wait(self, timeout=None):
+        return self.finished.wait(timeout)
+
+    def _produce(self):
+        epoch, position = None, 0
+        while not self._closed:
+            if self._cursor[0] != epoch:
+                epoch, source, position, end_frame = self._cursor
+
+            loop, loop_end = self._loop, 0
+            if loop is not None and source is not None:
+                loop_end = source.num_frames if loop[1] is None else min(loop[1], source.num_frames)
+            looping = loop is not None and loop[0] <= position < loop_end
+            stop = loop_end if looping else end_frame
+            count = min(self.blocksize, self.ring.writable(), stop - position) if source is not None else 0
+
+            if count <= 0:
+                if source is not None and position >= stop and not looping:
+                    self._drained_epoch = epoch
+                self._wake.wait(self.blocksize / self.sample_rate)
+                self._wake.clear()
+                continue
+
+            positions = np.arange(position, position + count)
+            self.ring.write(source.read(position, count), positions, epoch)
+            position += count
+            if looping and position >= loop_end:
+                position = loop[0]
+
+    def _gain_ramp(self, count):
+        version, target, fade_frames = self._fade
+        if version != self._fade_seen:
+            self._fade_seen, self._ramp_target, self._ramp_left = version, target, fade_frames
+            if fade_frames == 0:
+                self._gains = target.copy()
+
+        if self._ramp_left == 0 or count == 0:
+            return np.broadcast_to(self._gains, (count, self.tracks))
+        steps = np.minimum(np.arange(1, count + 1), self._ramp_left) / self._ramp_left
+        ramp = self._gains + (self._ramp_target - self._gains) * steps[:, None].astype(np.float32)
+        self._gains = ramp[-1].copy()
+        self._ramp_left -= min(count, self._ramp_left)
+        return ramp
+
+    def _callback(self, outdata, frames):
+        epoch = self._cursor[0]
+        self.ring.discard_stale(epoch)
+        if not self._playing:
+            outdata.fill(0)
+            return
+
+        data, positions = self.ring.read(frames)
+        count = len(data)
+        gains = self._gain_ramp(count)
+        mixed = (data.reshape(count, self.tracks, self.channels) * gains[:, :, None]).sum(axis=1)
+        outdata[:count] = mixed
+        outdata[count:] = 0
+
+        if count:
+            self._clock_frame = int(positions[-1]) + 1
+        elif self._drained_epoch == epoch:
+            self._playing = False
+            self.finished.set()
+        self._wake.set()
+
+    def close(self):
+        self._closed = True
+        self._wake.set()
+        self.backend.close()
+        self._producer.join()
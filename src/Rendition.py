@@ -0,0 +1,88 @@
+import json
+import os
+
+# files a download is decoded into, by one ffmpeg run. sample_rate and channels default to the
+# source's, codec and bitrate to ffmpeg's choice for the format; archive renditions are compressed
+# copies that are kept but never picked for decoding
+DEFAULT_RENDITIONS = {
+    "8k": {"sample_rate": 8000, "channels": 1, "format": "flac"}
+}
+
+# downloads from before renditions were registered, data/{id}.wav at the source's rate; the media
+# cache adopts them under this name and, having every rate, they stand in for any renditions
+LEGACY_RENDITION = "wav"
+
+
+def rendition_file(video_id, name, rendition):
+    return f"{video_id}.{name}.{rendition['format']}"
+
+
+def ffmpeg_output_args(rendition):
+    args = ["-map", "0:a:0"]
+    if rendition.get("sample_rate"):
+        args += ["-ar", str(rendition["sample_rate"])]
+    if rendition.get("channels"):
+        args += ["-ac", str(rendition["channels"])]
+    if rendition.get("codec"):
+        args += ["-c:a", rendition["codec"]]
+    if rendition.get("bitrate"):
+        args += ["-b:a", str(rendition["bitrate"])]
+    return args + ["-f", rendition["format"]]
+
+
+# what the per video json records of every rendition, entries are media cache manifest entries
+def describe_renditions(entries, renditions):
+    return {
+        name: {
+            "file": entry["file"],
+            "format": renditions[name]["format"],
+            "sample_rate": entry["sample_rate"],
+            "channels": entry["channels"],
+            "duration": entry["duration"],
+            "archive": bool(renditions[name].get("archive", False))
+        } for name, entry in entries.items() if name in renditions
+    }
+
+
+# the smallest rendition at or above sample_rate, so nothing is upsampled and the least is decoded,
+# else the highest below it; a matching channel count breaks ties
+def closest_rendition(renditions, sample_rate=None, channels=None):
+    candidates = {name: value for name, value in renditions.items() if not value.get("archive")} or renditions
+
+    def channel_miss(name):
+        return int(channels is not None and candidates[name]["channels"] != channels)
+
+    above = [name for name in candidates if sample_rate is None or candidates[name]["sample_rate"] >= sample_rate]
+    if sample_rate is None:
+        return max(above, key=lambda name: (candidates[name]["sample_rate"], -channel_miss(name)))
+    if above:
+        return min(above, key=lambda name: (candidates[name]["sample_rate"], channel_miss(name)))
+    return max(candidates, key=lambda name: (candidates[name]["sample_rate"], -channel_miss(name)))
+
+
+# whether the cached {rendition name: path} of a video, from MediaCache.get, serves renditions
+def has_renditions(cached, renditions):
+    return cached is not None and (set(renditions) <= set(cached) or LEGACY_RENDITION in cached)
+
+
+# ids of the videos under a data directory: {id}.wav downloads and {id}.{rendition}.{format}
+# renditions, youtube ids have no dots
+def video_ids(data_path):
+    return sorted({
+        file_name.split(".")[0] for file_name in os.listdir(data_path)
+        if not file_name.endswith(".tmp") and not file_name.startswith(".")
+    })
+
+
+# path of the rendition of a video closest to sample_rate, {id}.wav for downloads from before
+# renditions were registered; data_path is audio_path/data unless given
+def rendition_path(audio_path, video_id, sample_rate=None, channels=None, data_path=None):
+    data_path = data_path or os.path.join(audio_path, "data")
+    config_path = os.path.join(audio_path, "config", video_id + ".json")
+    if os.path.exists(config_path):
+        with open(config_path, "r", encoding="utf-8") as j_file:
+            renditions = json.load(j_file).get("renditions")
+        if renditions:
+            name = closest_rendition(renditions, sample_rate, channels)
+            return os.path.join(data_path, renditions[name]["file"])
+    return os.path.join(data_path, video_id + ".wav")
@@ -0,0 +1,15 @@
+import os
+
+import numpy as np
+
+EMPTY_START = 1
+EMPTY_END = 2
+
+
+# a segment file: start and end seconds of every segment of a changed audio, in order, with the
+# empty padding around it flagged EMPTY_START and EMPTY_END
+def save_segments(path, seconds_per_segment, starts, ends, flags):
+    tmp_path = path + ".tmp"
+    with open(tmp_path, "wb") as file:
+        np.savez(file, seconds_per_segment=np.float64(seconds_per_segment), starts=starts, ends=ends, flags=flags)
+    os.replace(tmp_path, path)
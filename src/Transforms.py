@@ -0,0 +1,25 @@
+from functools import lru_cache
+
+import torch
+from torchaudio.transforms import MelSpectrogram, Resample
+
+
+# transforms hold precomputed sinc/filterbank kernels, build each one once per process and device.
+# The instances are shared, so callers look them up instead of holding them as submodules that a
+# .to() would move
+def get_resample(orig_sr, new_sr, dtype=torch.float32, device="cpu"):
+    return _get_resample(int(orig_sr), int(new_sr), dtype, str(torch.device(device)))
+
+
+def get_mel_spectrogram(sample_rate, n_mels, n_fft, device="cpu"):
+    return _get_mel_spectrogram(int(sample_rate), n_mels, n_fft, str(torch.device(device)))
+
+
+@lru_cache(maxsize=64)
+def _get_resample(orig_sr, new_sr, dtype, device):
+    return Resample(orig_sr, new_sr, dtype=dtype).to(device)
+
+
+@lru_cache(maxsize=8)
+def _get_mel_spectrogram(sample_rate, n_mels, n_fft, device):
+    return MelSpectrogram(sample_rate=sample_rate, n_mels=n_mels, n_fft=n_fft).to(device)
@@ -3,31 +3,121 @@ import json
 from pytube import YouTube, Channel
 import os
 import subprocess
+import threading
 
 from pytube.exceptions import RegexMatchError
 
+from .MediaCache import MediaCache
+from .Rendition import (
+    DEFAULT_RENDITIONS, describe_renditions, ffmpeg_output_args, has_renditions, rendition_file, rendition_path
+)
+
+
+# one ffmpeg run decodes the download into every rendition, each written to a temp file first so a
+# killed transcode never leaves a file that looks complete; returns {rendition name: path}
+def transcode(input_path, output_dir, video_id, renditions=None):
+    renditions = renditions or DEFAULT_RENDITIONS
+    paths = {name: os.path.join(output_dir, rendition_file(video_id, name, value)) for name, value in renditions.items()}
+
+    command = ["ffmpeg", "-y", "-loglevel", "error", "-i", input_path]
+    for name, value in renditions.items():
+        command += ffmpeg_output_args(value) + [paths[name] + ".tmp"]
+    subprocess.run(command, check=True, stdout=subprocess.DEVNULL)
+
+    for path in paths.values():
+        os.replace(path + ".tmp", path)
+    return paths
+
+
+class PytubeBackend:
+    @staticmethod
+    def channel(channel_url):
+        return Channel(channel_url)
+
+    @staticmethod
+    def video(video_url):
+        return YouTube(video_url)
+
 
 class YouTubeVideo:
     @staticmethod
-    def get_videos_from_channel(channel_url):
+    def open_channel(channel_url, backend):
+        try:
+            return backend.channel(channel_url)
+        except RegexMatchError:
+            raise ValueError("invalid channel url")
+
+    # pages of page_size videos: channel urls are paged in lazily and the metadata of a page comes
+    # from the store in one query, so a large channel starts listing after its first page. A
+    # channel already opened with open_channel is reused instead of built again
+    @staticmethod
+    def iter_channel_pages(channel_url, page_size=30, store=None, backend=None, channel=None):
+        backend = backend or PytubeBackend()
+        channel = channel or YouTubeVideo.open_channel(channel_url, backend)
         try:
-            channel = Channel(channel_url)
-            return channel.channel_name, [YouTubeVideo(video) for video in channel.videos]
+            urls = channel.url_generator()
+        except RegexMatchError:
+            raise ValueError("invalid channel url")
+
+        page = []
+        for url in urls:
+            page.append(backend.video(url))
+            if len(page) == page_size:
+                yield YouTubeVideo.from_page(page, store)
+                page = []
+        if page:
+            yield YouTubeVideo.from_page(page, store)
 
+    @staticmethod
+    def from_page(videos, store=None):
+        fresh = store.get_many([video.video_id for video in videos]) if store is not None else {}
+        return [YouTubeVideo(video, store, fresh.get(video.video_id)) for video in videos]
+
+    @staticmethod
+    def get_videos_from_channel(channel_url, store=None, backend=None):
+        backend = backend or PytubeBackend()
+        channel = YouTubeVideo.open_channel(channel_url, backend)
+        try:
+            channel_name = channel.channel_name
         except RegexMatchError:
             raise ValueError("invalid channel url")
+        pages = YouTubeVideo.iter_channel_pages(channel_url, store=store, backend=backend, channel=channel)
+        return channel_name, [video for page in pages for video in page]
 
     @staticmethod
-    def get_video_from_url(video_url):
+    def get_video_from_url(video_url, store=None, backend=None):
+        backend = backend or PytubeBackend()
         try:
-            video = YouTube(video_url)
-            return YouTubeVideo(video)
+            video = backend.video(video_url)
+            return YouTubeVideo(video, store)
 
         except RegexMatchError:
             raise ValueError("invalid video url")
 
-    def __init__(self, video):
+    # metadata is read from pytube once per video, all fields together, unless the store has it fresh
+    def __init__(self, video, store=None, metadata=None):
         self.video = video
+        self.store = store
+        self._metadata = metadata
+        self.lock = threading.Lock()
+
+    @property
+    def metadata(self):
+        with self.lock:
+            if self._metadata is None and self.store is not None:
+                self._metadata = self.store.get(self.id)
+            if self._metadata is None:
+                self._metadata = {
+                    "title": self.video.title,
+                    "description": self.video.description,
+                    "author": self.video.author,
+                    "keywords": self.video.keywords,
+                    "views": self.video.views,
+                    "link": self.video.watch_url
+                }
+                if self.store is not None:
+                    self.store.put(self.id, self._metadata)
+            return self._metadata
 
     @property
     def id(self):
@@ -35,60 +125,68 @@ class YouTubeVideo:
 
     @property
     def title(self):
-        return self.video.title
+        return self.metadata["title"]
 
     @property
     def description(self):
-        return self.video.description
+        return self.metadata["description"]
 
     @property
     def author(self):
-        return self.video.author
+        return self.metadata["author"]
 
     @property
     def keywords(self):
-        return self.video.keywords
+        return self.metadata["keywords"]
 
     @property
     def views(self):
-        return self.video.views
+        return self.metadata["views"]
 
     @property
     def link(self):
-        return self.video.watch_url
+        return self.metadata["link"]
 
-    def getMP3(self, audio_path, download_overwrite):
-        mp4_path = os.path.join(audio_path, "__cache__", self.id + ".mp4")
-        wav_path = os.path.join(audio_path, "data", self.id + ".wav")
+    # renditions are served from the media cache while they still validate, a download is
+    # transcoded into __cache__ and only moved into data once every rendition decodes. Returns the
+    # rendition closest to sample_rate and the per video json that registers them all
+    def getMP3(self, audio_path, download_overwrite, media_cache=None, renditions=None, sample_rate=None):
+        media_cache = media_cache or MediaCache(audio_path)
+        renditions = renditions or DEFAULT_RENDITIONS
+        mp4_path = os.path.join(media_cache.cache_path, self.id + ".mp4")
         config_path = os.path.join(audio_path, "config", self.id + ".json")
 
-        if not (os.path.exists(wav_path) and os.path.exists(config_path)) or download_overwrite:
-            self.video.streams.filter(only_audio=True).first().download(
-                output_path=os.path.join(audio_path, "__cache__"),
-                filename=self.id + ".mp4",
-                skip_existing=True
-            )
-            subprocess.call([
-                'ffmpeg', '-y', '-i',
-                mp4_path,
-                wav_path
-            ])
-            os.remove(mp4_path)
+        with media_cache.lock(self.id):
+            cached = media_cache.get(self.id)
+            if download_overwrite or not has_renditions(cached, renditions) or not os.path.exists(config_path):
+                self.metadata
+                self.video.streams.filter(only_audio=True).first().download(
+                    output_path=media_cache.cache_path,
+                    filename=self.id + ".mp4",
+                    skip_existing=not download_overwrite
+                )
+                media_cache.touch(mp4_path)
+                entries = media_cache.put(
+                    self.id, transcode(mp4_path, media_cache.cache_path, self.id, renditions)
+                )
+                self.save_config(config_path, describe_renditions(entries, renditions))
 
-            with open(config_path, "w", encoding="utf-8") as j_file:
-                json.dump(self.to_dict(), j_file, indent=2, ensure_ascii=False)
+        media_cache.evict()
+        return rendition_path(audio_path, self.id, sample_rate), config_path
 
-        return wav_path, config_path
+    # writes the metadata fetched before, a video whose metadata was never read is an error
+    def save_config(self, config_path, renditions=None):
+        if self._metadata is None:
+            raise ValueError(f"metadata of {self.id} was not fetched")
+        video_config = self.to_dict()
+        if renditions is not None:
+            video_config["renditions"] = renditions
+        with open(config_path + ".tmp", "w", encoding="utf-8") as j_file:
+            json.dump(video_config, j_file, indent=2, ensure_ascii=False)
+        os.replace(config_path + ".tmp", config_path)
 
     def to_dict(self):
-        return {
-            "title": self.video.title,
-            "description": self.video.description,
-            "author": self.video.author,
-            "keywords": self.video.keywords,
-            "views": self.video.views,
-            "link": self.video.watch_url
-        }
+        return dict(self.metadata)
 
 
     # def __init__(self, data_root):
@@ -1,5 +1,30 @@
-from .YouTubeMP3 import *
+import importlib
+
 from .Config import *
 from .AudioPlayer import *
+from .AudioCache import *
+from .AudioReader import *
+from .Aligner import *
+from .MediaCache import *
+from .Rendition import *
+from .Segments import *
+from .MetadataStore import *
+from .PlaybackEngine import *
+
+# the download side needs pytube, its names are imported on first use so the training code
+# importing src.AudioReader or src.Rendition runs without it
+_lazy_modules = {
+    "YouTubeVideo": "YouTubeMP3", "PytubeBackend": "YouTubeMP3",
+    "IngestService": "Ingest", "PytubeDownloader": "Ingest"
+}
+
+__all__ = ["YouTubeVideo", "Config", "AudioPlayer", "SourceAudioCache", "AudioReader", "load_resampled", "Aligner", "DTWAligner",
+           "IngestService", "PytubeDownloader", "MediaCache", "rendition_path", "save_segments",
+           "MetadataStore", "PytubeBackend",
+           "PlaybackEngine", "ArraySource", "OverlaySource", "NullBackend", "SoundDeviceBackend"]
+
 
-__all__ = ["YouTubeVideo", "Config", "AudioPlayer"]
+def __getattr__(name):
+    if name not in _lazy_modules:
+        raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
+    return getattr(importlib.import_module("." + _lazy_modules[name], __name__), name)
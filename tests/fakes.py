@@ -0,0 +1,115 @@
+import os
+import shutil
+import threading
+import time
+import wave
+
+import numpy as np
+
+from src.Rendition import rendition_file
+
+
+# serves downloads from local files named {video id}.*, fails the first `failures` tries of every id
+class FakeDownloader:
+    def __init__(self, source_dir, failures=0, delay=0.0):
+        self.source_dir = source_dir
+        self.failures = failures
+        self.delay = delay
+        self.attempts = {}
+        self.lock = threading.Lock()
+
+    def download(self, video, output_dir, filename):
+        with self.lock:
+            self.attempts[video.id] = self.attempts.get(video.id, 0) + 1
+            attempt = self.attempts[video.id]
+        time.sleep(self.delay)
+        if attempt <= self.failures:
+            raise IOError(f"fake download of {video.id} failed, attempt {attempt}")
+
+        sources = [path for path in os.listdir(self.source_dir) if os.path.splitext(path)[0] == video.id]
+        if not sources:
+            raise FileNotFoundError(f"no local file for {video.id}")
+        shutil.copyfile(os.path.join(self.source_dir, sources[0]), os.path.join(output_dir, filename))
+        return os.path.join(output_dir, filename)
+
+
+# channels and videos served from dicts instead of youtube: videos is {id: to_dict fields} and
+# channels is {channel url: (channel name, [video ids])}; every metadata read sleeps `delay` and is
+# counted in fetches, like a pytube property that goes to the network
+class FakeBackend:
+    def __init__(self, videos, channels=None, delay=0.0):
+        self.videos = videos
+        self.channels = channels or {}
+        self.delay = delay
+        self.fetches = {}
+        self.channel_builds = 0
+        self.lock = threading.Lock()
+
+    def channel(self, channel_url):
+        if channel_url not in self.channels:
+            raise ValueError("invalid channel url")
+        self.channel_builds += 1
+        name, video_ids = self.channels[channel_url]
+        return FakeChannel(name, ["https://www.youtube.com/watch?v=" + video_id for video_id in video_ids])
+
+    def video(self, video_url):
+        video_id = video_url.split("v=")[-1]
+        if video_id not in self.videos:
+            raise ValueError("invalid video url")
+        return FakeVideo(self, video_id)
+
+    def fetch(self, video_id, field):
+        with self.lock:
+            self.fetches[video_id] = self.fetches.get(video_id, 0) + 1
+        time.sleep(self.delay)
+        return self.videos[video_id][field]
+
+
+class FakeChannel:
+    def __init__(self, channel_name, video_urls):
+        self.channel_name = channel_name
+        self.video_urls = video_urls
+
+    def url_generator(self):
+        yield from self.video_urls
+
+
+class FakeVideo:
+    fields = {"title": "title", "description": "description", "author": "author", "keywords": "keywords",
+              "views": "views", "watch_url": "link"}
+
+    def __init__(self, backend, video_id):
+        self.backend = backend
+        self.video_id = video_id
+
+    def __getattr__(self, name):
+        if name not in FakeVideo.fields:
+            raise AttributeError(name)
+        return self.backend.fetch(self.video_id, FakeVideo.fields[name])
+
+
+def video_fields(video_id):
+    return {
+        "title": "title " + video_id, "description": "", "author": "author", "keywords": [],
+        "views": 0, "link": "https://www.youtube.com/watch?v=" + video_id
+    }
+
+
+# 16 bit pcm wav of noise, written with the standard library so the tests need no audio backend
+def write_wav(path, seconds=1.0, sample_rate=8000, channels=1, seed=0):
+    samples = np.random.default_rng(seed).uniform(-0.1, 0.1, (int(seconds * sample_rate), channels))
+    with wave.open(path, "wb") as file:
+        file.setnchannels(channels)
+        file.setsampwidth(2)
+        file.setframerate(sample_rate)
+        file.writeframes((samples * 32767).astype("<i2").tobytes())
+
+
+# stands in for the ffmpeg transcode: every rendition is a copy of the wav download
+def copy_transcode(input_path, output_dir, video_id, renditions):
+    paths = {}
+    for name, rendition in renditions.items():
+        paths[name] = os.path.join(output_dir, rendition_file(video_id, name, rendition))
+        shutil.copyfile(input_path, paths[name] + ".tmp")
+        os.replace(paths[name] + ".tmp", paths[name])
+    return paths
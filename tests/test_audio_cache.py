@@ -0,0 +1,36 @@
+import hashlib
+import os
+from concurrent.futures import ThreadPoolExecutor
+
+from src.AudioCache import SourceAudioCache
+from tests.fakes import write_wav
+
+
+def file_sha1(path):
+    with open(path, "rb") as file:
+        return hashlib.sha1(file.read()).hexdigest()
+
+
+def test_concurrent_hashes_are_all_kept(tmp_path):
+    paths = [str(tmp_path / f"{index}.wav") for index in range(16)]
+    for seed, path in enumerate(paths):
+        write_wav(path, seconds=0.1, seed=seed)
+
+    cache_path = str(tmp_path / "cache")
+    caches = [SourceAudioCache(cache_path) for _ in range(4)]
+    with ThreadPoolExecutor(8) as pool:
+        hashes = list(pool.map(lambda index: caches[index % 4].content_hash(paths[index]), range(len(paths))))
+
+    assert hashes == [file_sha1(path) for path in paths]
+    assert len(os.listdir(os.path.join(cache_path, "hashes"))) == len(paths)
+
+
+def test_changed_file_is_hashed_again(tmp_path):
+    path = str(tmp_path / "a.wav")
+    write_wav(path, seconds=0.1, seed=0)
+    cache = SourceAudioCache(str(tmp_path / "cache"))
+    first = cache.content_hash(path)
+
+    write_wav(path, seconds=0.2, seed=1)
+    assert cache.content_hash(path) != first
+    assert SourceAudioCache(str(tmp_path / "cache")).content_hash(path) == file_sha1(path)
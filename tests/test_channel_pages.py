@@ -0,0 +1,56 @@
+from src.MetadataStore import MetadataStore
+from src.YouTubeMP3 import YouTubeVideo
+from tests.fakes import FakeBackend, video_fields
+
+CHANNEL_URL = "https://www.youtube.com/@fake"
+
+
+def make_backend(num_videos):
+    video_ids = [f"v{i:02d}" for i in range(num_videos)]
+    return FakeBackend(
+        {video_id: video_fields(video_id) for video_id in video_ids}, {CHANNEL_URL: ("fake channel", video_ids)}
+    ), video_ids
+
+
+def test_channel_pages_are_served_from_the_store(tmp_path):
+    store = MetadataStore(str(tmp_path / "metadata.sqlite"))
+    backend, video_ids = make_backend(7)
+
+    pages = list(YouTubeVideo.iter_channel_pages(CHANNEL_URL, page_size=3, store=store, backend=backend))
+    assert [len(page) for page in pages] == [3, 3, 1]
+    assert [video.title for page in pages for video in page] == ["title " + video_id for video_id in video_ids]
+    # the six fields of a video are read together, once
+    assert backend.fetches == {video_id: 6 for video_id in video_ids}
+
+    backend.fetches.clear()
+    pages = list(YouTubeVideo.iter_channel_pages(CHANNEL_URL, page_size=3, store=store, backend=backend))
+    assert [video.link for page in pages for video in page] == [video_fields(video_id)["link"] for video_id in video_ids]
+    assert backend.fetches == {}
+
+
+def test_channel_pages_are_lazy(tmp_path):
+    backend, _ = make_backend(100)
+    pages = YouTubeVideo.iter_channel_pages(CHANNEL_URL, page_size=10, backend=backend)
+
+    first = next(pages)
+    assert len(first) == 10
+    assert backend.fetches == {}
+
+
+def test_stale_rows_are_fetched_again(tmp_path):
+    store = MetadataStore(str(tmp_path / "metadata.sqlite"), ttl_seconds=-1)
+    backend, video_ids = make_backend(2)
+
+    for _ in range(2):
+        for page in YouTubeVideo.iter_channel_pages(CHANNEL_URL, store=store, backend=backend):
+            assert [video.author for video in page] == ["author", "author"]
+    assert backend.fetches == {video_id: 12 for video_id in video_ids}
+
+
+def test_channel_is_built_once(tmp_path):
+    backend, video_ids = make_backend(5)
+
+    channel_name, videos = YouTubeVideo.get_videos_from_channel(CHANNEL_URL, backend=backend)
+    assert channel_name == "fake channel"
+    assert [video.id for video in videos] == video_ids
+    assert backend.channel_builds == 1
@@ -0,0 +1,66 @@
+import json
+import os
+import types
+
+from src.Ingest import IngestService
+from src.YouTubeMP3 import YouTubeVideo
+from tests.fakes import FakeDownloader, copy_transcode, video_fields, write_wav
+
+RENDITIONS = {"full": {"format": "wav"}}
+
+
+def make_videos(source_dir, video_ids):
+    os.makedirs(source_dir, exist_ok=True)
+    for seed, video_id in enumerate(video_ids):
+        write_wav(os.path.join(source_dir, video_id + ".wav"), seed=seed)
+    return [YouTubeVideo(types.SimpleNamespace(video_id=video_id), metadata=video_fields(video_id)) for video_id in video_ids]
+
+
+def make_service(audio_path, downloader, events=None, retries=2):
+    return IngestService(
+        audio_path, downloader, transcoder=copy_transcode, transcode_workers=1, retries=retries, retry_delay=0.01,
+        renditions=RENDITIONS, progress=events.append if events is not None else None
+    )
+
+
+def test_download_is_retried(tmp_path):
+    videos = make_videos(str(tmp_path / "sources"), ["a", "b"])
+    downloader = FakeDownloader(str(tmp_path / "sources"), failures=1)
+    events = []
+
+    results, failures = make_service(str(tmp_path / "audio"), downloader, events).run(videos)
+
+    assert failures == []
+    assert sorted(video_id for video_id, _, _ in results) == ["a", "b"]
+    assert downloader.attempts == {"a": 2, "b": 2}
+    assert sum(event["stage"] == "download" and event["status"] == "retry" for event in events) == 2
+    with open(tmp_path / "audio" / "config" / "a.json", encoding="utf-8") as file:
+        config = json.load(file)
+    assert config["title"] == "title a" and "full" in config["renditions"]
+
+
+def test_download_fails_after_retries(tmp_path):
+    videos = make_videos(str(tmp_path / "sources"), ["a"])
+    downloader = FakeDownloader(str(tmp_path / "sources"), failures=5)
+
+    results, failures = make_service(str(tmp_path / "audio"), downloader, retries=1).run(videos)
+
+    assert results == []
+    assert [video.id for video, _ in failures] == ["a"]
+    assert "attempt 2" in failures[0][1]
+    assert downloader.attempts == {"a": 2}
+    assert not os.path.exists(tmp_path / "audio" / "config" / "a.json")
+
+
+def test_rerun_skips_finished_ids(tmp_path):
+    videos = make_videos(str(tmp_path / "sources"), ["a", "b"])
+    make_service(str(tmp_path / "audio"), FakeDownloader(str(tmp_path / "sources"))).run(videos)
+
+    downloader = FakeDownloader(str(tmp_path / "sources"))
+    service = make_service(str(tmp_path / "audio"), downloader)
+    results, failures = service.run(videos + make_videos(str(tmp_path / "sources"), ["c"]))
+
+    assert failures == []
+    assert [video_id for video_id, _, _ in results] == ["c"]
+    assert downloader.attempts == {"c": 1}
+    assert service.counts == {"done": 1, "skipped": 2, "failed": 0}
@@ -0,0 +1,36 @@
+import os
+import struct
+
+from src.MediaCache import MediaCache
+from src.Rendition import LEGACY_RENDITION
+from tests.fakes import write_wav
+
+
+def write_unfinished(path, riff_size, data_size):
+    with open(path, "r+b") as file:
+        file.seek(4)
+        file.write(struct.pack("<I", riff_size))
+        file.seek(40)
+        file.write(struct.pack("<I", data_size))
+
+
+def test_finished_wav_is_adopted(tmp_path):
+    cache = MediaCache(str(tmp_path))
+    write_wav(cache.path("a.wav"))
+    assert cache.get("a") == {LEGACY_RENDITION: cache.path("a.wav")}
+
+
+def test_wav_of_a_killed_transcode_is_not_adopted(tmp_path):
+    cache = MediaCache(str(tmp_path))
+    write_wav(cache.path("a.wav"))
+    write_unfinished(cache.path("a.wav"), 0xFFFFFFFF, 0xFFFFFFFF)
+    assert cache.get("a") is None
+    assert cache.entry("a") is None
+
+
+def test_truncated_wav_is_not_adopted(tmp_path):
+    cache = MediaCache(str(tmp_path))
+    write_wav(cache.path("a.wav"))
+    with open(cache.path("a.wav"), "r+b") as file:
+        file.truncate(os.path.getsize(cache.path("a.wav")) // 2)
+    assert cache.get("a") is None
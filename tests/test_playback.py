@@ -0,0 +1,74 @@
+import time
+
+import numpy as np
+import torch
+
+from src.PlaybackEngine import ArraySource, NullBackend, PlaybackEngine
+
+SAMPLE_RATE = 1000
+BLOCKSIZE = 16
+
+
+# every frame plays its own index, so the recorded output tells which frames were heard
+def make_engine(num_frames=400):
+    backend = NullBackend(realtime=False, record=True)
+    engine = PlaybackEngine(SAMPLE_RATE, 1, backend=backend, blocksize=BLOCKSIZE)
+    engine.load(ArraySource([torch.arange(num_frames, dtype=torch.float32)[None]], 1))
+    return engine, backend
+
+
+# the producer renders on its own thread, each block is pumped once it is buffered
+def pump(engine, backend, blocks):
+    for _ in range(blocks):
+        engine.ring.discard_stale(engine._cursor[0])
+        deadline = time.perf_counter() + 2.0
+        while engine.ring.readable() < BLOCKSIZE and time.perf_counter() < deadline:
+            time.sleep(0.001)
+        backend.pump()
+
+
+def heard(backend, skip=0):
+    return np.rint(backend.recorded()[skip:, 0]).astype(np.int64)
+
+
+def test_seek_plays_from_the_new_position():
+    engine, backend = make_engine()
+    try:
+        engine.play()
+        pump(engine, backend, 2)
+        engine.seek(0.3)
+        pump(engine, backend, 2)
+        assert heard(backend).tolist() == list(range(2 * BLOCKSIZE)) + list(range(300, 300 + 2 * BLOCKSIZE))
+        assert engine.clock_frame == 300 + 2 * BLOCKSIZE
+    finally:
+        engine.close()
+
+
+def test_loop_without_end_wraps_at_the_end_of_the_source():
+    engine, backend = make_engine()
+    try:
+        engine.play()
+        engine.set_loop(0.3, None)
+        pump(engine, backend, 50)
+        expected = np.concatenate((np.arange(400), np.tile(np.arange(300, 400), 5)))[:50 * BLOCKSIZE]
+        assert heard(backend).tolist() == expected.tolist()
+        assert engine.playing
+    finally:
+        engine.close()
+
+
+def test_volume_fades_linearly():
+    engine, backend = make_engine()
+    try:
+        engine.play()
+        pump(engine, backend, 1)
+        engine.set_gains([0.0], fade_seconds=2 * BLOCKSIZE / SAMPLE_RATE)
+        pump(engine, backend, 3)
+
+        output = backend.recorded()[BLOCKSIZE:, 0]
+        frames = np.arange(BLOCKSIZE, 4 * BLOCKSIZE)
+        gains = 1 - np.minimum(np.arange(1, 3 * BLOCKSIZE + 1), 2 * BLOCKSIZE) / (2 * BLOCKSIZE)
+        np.testing.assert_allclose(output, frames * gains, atol=1e-3)
+        np.testing.assert_array_equal(engine.gains, [0.0])
+    finally:
+        engine.close()